@@ -0,0 +1,471 @@
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+
+
+#write a 300-DPI letter sized page with some text on it and return its path
+def synthetic_page_image(folder, width=2550, height=3300, seed=0):
+    rng = random.Random(seed)
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    for line in range(120, height - 120, 60):
+        words = " ".join(rng.choice(["lorem", "ipsum", "dolor", "sit", "amet", "figure", "table"]) for _ in range(12))
+        cv2.putText(page, words, (150, line), cv2.FONT_HERSHEY_SIMPLEX, 1.4, (0, 0, 0), 2)
+    image_path = os.path.join(folder, "page_1.jpg")
+    cv2.imwrite(image_path, page)
+    return image_path
+
+#random layout-like rectangles (x1, y1, x2, y2) inside the page
+def synthetic_blocks(width, height, count, seed=0):
+    rng = random.Random(seed)
+    blocks = []
+    for _ in range(count):
+        x1 = rng.uniform(0, width * 0.6)
+        y1 = rng.uniform(0, height * 0.9)
+        blocks.append((x1, y1, min(width, x1 + rng.uniform(200, width * 0.4)), min(height, y1 + rng.uniform(40, 300))))
+    return blocks
+
+#old path: every block decodes the page again and round-trips its crop through a png file
+def legacy_page(image_path, blocks, ocr):
+    for x1, y1, x2, y2 in blocks:
+        img = cv2.imread(image_path)
+        x1, y1 = max(0, x1 - 5), max(0, y1 - 5)
+        x2, y2 = min(img.shape[1], x2 + 5), min(img.shape[0], y2 + 5)
+        cropped_image = img[int(y1):int(y2), int(x1):int(x2)]
+        cropped_image_path = os.path.join(os.path.dirname(image_path), "text_block.png")
+        cv2.imwrite(cropped_image_path, cropped_image)
+        image = Image.open(cropped_image_path)
+        if ocr:
+            pytesseract.image_to_string(image)
+        else:
+            image.load()
+        os.remove(cropped_image_path)
+
+#new path: decode once, crops are views handed to PIL in memory
+def in_memory_page(image_path, blocks, ocr):
+    img = cv2.imread(image_path)[..., ::-1]
+    for x1, y1, x2, y2 in blocks:
+        x1, y1 = max(0, x1 - 5), max(0, y1 - 5)
+        x2, y2 = min(img.shape[1], x2 + 5), min(img.shape[0], y2 + 5)
+        image = Image.fromarray(img[int(y1):int(y2), int(x1):int(x2)])
+        if ocr:
+            pytesseract.image_to_string(image)
+
+def time_pages(func, image_path, blocks, ocr, pages):
+    timings = []
+    for _ in range(pages):
+        start_time = time.perf_counter()
+        func(image_path, blocks, ocr)
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+def report(name, timings):
+    print(f"{name:<12} mean {statistics.mean(timings) * 1000:9.1f} ms/page   "
+          f"min {min(timings) * 1000:9.1f} ms   max {max(timings) * 1000:9.1f} ms")
+
+#per-page latency of the block crop pipeline before and after the in-memory change
+def bench_crops(args):
+    with tempfile.TemporaryDirectory() as folder:
+        image_path = args.image or synthetic_page_image(folder)
+        height, width = cv2.imread(image_path).shape[:2]
+        blocks = synthetic_blocks(width, height, args.blocks)
+        print(f"{width}x{height} page, {len(blocks)} blocks, {args.pages} pages, ocr={'on' if args.ocr else 'off'}")
+        before = time_pages(legacy_page, image_path, blocks, args.ocr, args.pages)
+        after = time_pages(in_memory_page, image_path, blocks, args.ocr, args.pages)
+        report("file crops", before)
+        report("in-memory", after)
+        print(f"speedup      {statistics.mean(before) / statistics.mean(after):.2f}x")
+
+#pages/sec of ModelLoader.detect_batch for several batch sizes, checked against single image detect()
+def bench_detect_batch(args):
+    import fitz
+    from model_loader import ModelLoader
+
+    document = fitz.open(args.pdf)
+    images = []
+    for page_num in range(min(args.pages, len(document))):
+        pixmap = document[page_num].get_pixmap(matrix=fitz.Matrix(args.dpi / 72, args.dpi / 72), alpha=False)
+        images.append(np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n))
+
+    for model_name in ("PubLayNet", "TableBank"):
+        loader = ModelLoader(model_name)
+        reference = [loader.model.detect(image) for image in images]
+        batched = loader.detect_batch(images)
+        mismatches = sum(
+            [(b.type, b.coordinates) for b in single] != [(b.type, b.coordinates) for b in batch]
+            for single, batch in zip(reference, batched))
+        print(f"{model_name}: {len(images)} pages, {mismatches} pages differ from the single image path")
+        for batch_size in args.batch_sizes:
+            start_time = time.perf_counter()
+            for start in range(0, len(images), batch_size):
+                loader.detect_batch(images[start:start + batch_size])
+            total_time = time.perf_counter() - start_time
+            print(f"  batch {batch_size:>2}: {len(images) / total_time:6.2f} pages/sec")
+
+#text accuracy and cost of one tesseract pass per page against one pass per block, over a corpus of PDFs
+def bench_ocr_accuracy(args):
+    import difflib
+    import fitz
+    from model_loader import ModelLoader
+    from page_text import BlockOCR, PageWordOCR
+
+    publaynet = ModelLoader("PubLayNet")
+    similarities = []
+    block_time = page_time = 0.0
+    block_calls = pages = 0
+    for pdf in args.pdfs:
+        document = fitz.open(pdf)
+        for page_num in range(min(args.pages, len(document))):
+            pixmap = document[page_num].get_pixmap(matrix=fitz.Matrix(args.dpi / 72, args.dpi / 72), alpha=False)
+            image = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+            blocks = [block for block in publaynet.model.detect(image) if block.type in ("Text", "Title", "List")]
+
+            start_time = time.perf_counter()
+            block_ocr = BlockOCR(image)
+            block_texts = [block_ocr.text(block) for block in blocks]
+            block_time += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            page_ocr = PageWordOCR(image)
+            page_texts = [page_ocr.text(block) for block in blocks]
+            page_time += time.perf_counter() - start_time
+
+            for block_text, page_text in zip(block_texts, page_texts):
+                similarities.append(difflib.SequenceMatcher(None, " ".join(block_text.split()), " ".join(page_text.split())).ratio())
+            block_calls += len(blocks)
+            pages += 1
+
+    print(f"{pages} pages, {len(similarities)} text blocks")
+    print(f"per-block: {block_calls / max(pages, 1):5.1f} tesseract runs/page {block_time / max(pages, 1):7.2f} s/page")
+    print(f"per-page:  {1:5.1f} tesseract runs/page {page_time / max(pages, 1):7.2f} s/page")
+    if similarities:
+        print(f"block text similarity: mean {statistics.mean(similarities):.4f} median {statistics.median(similarities):.4f} "
+              f"min {min(similarities):.4f}, {sum(s < 0.95 for s in similarities)} blocks below 0.95")
+
+#OCR service response for a page with `lines` result lines and `tables` tables, each with a caption above it
+def synthetic_table_response(lines, tables, width=2550, height=3300, seed=0):
+    rng = random.Random(seed)
+    result = []
+    for _ in range(lines):
+        x1, y1 = rng.uniform(0, width - 400), rng.uniform(0, height - 40)
+        x2, y2 = x1 + rng.uniform(50, 400), y1 + rng.uniform(15, 40)
+        result.append([[[x1, y1], [x2, y1], [x2, y2], [x1, y2]], (f"line {len(result)}", 0.99)])
+    layout = []
+    for table in range(tables):
+        y1 = (table + 0.5) * height / (tables + 1)
+        layout.append({"type": "table_caption", "bbox": [150, y1 - 60, 900, y1 - 20]})
+        layout.append({"type": "table", "bbox": [150, y1, width - 150, y1 + height / (tables + 2)], "res": {"html": ""}})
+    return {"layout": layout, "result": [result]}
+
+#old caption matching: python loop over every result line, distance between the first corners only
+def legacy_table_captions(data):
+    closest_values = []
+    for layout_obj in data["layout"]:
+        if layout_obj["type"] == "table_caption" and "bbox" in layout_obj:
+            layout_bbox = layout_obj["bbox"]
+            min_distance = float('inf')
+            closest_result = None
+            for result_item in data["result"]:
+                for bbox_and_value in result_item:
+                    result_bbox = bbox_and_value[0][0]
+                    distance = math.sqrt((layout_bbox[0] - result_bbox[0])**2 + (layout_bbox[1] - result_bbox[1])**2)
+                    if distance < min_distance:
+                        min_distance = distance
+                        closest_result = bbox_and_value
+            if closest_result:
+                closest_values.append(closest_result[1][0])
+    return closest_values
+
+#assert the python loop and the array paths of tablecaption pick the same boxes: the boxes of OCR
+#quads, and the closest boxes on random boxes with small integer coordinates, so overlaps and equal
+#distances (the tie-break) are common
+def check_closest_boxes(cases=2000, seed=0):
+    from tablecaption import closest_boxes_arrays, closest_boxes_loop, quad_box, result_boxes
+
+    rng = random.Random(seed)
+    def box():
+        x1, y1 = rng.randint(0, 20), rng.randint(0, 20)
+        return (x1, y1, x1 + rng.randint(0, 10), y1 + rng.randint(0, 10))
+    for _ in range(cases):
+        entries = [[[[rng.uniform(0, 100), rng.uniform(0, 100)] for _ in range(4)], ("line", 0.9)] for _ in range(rng.randint(1, 10))]
+        assert [quad_box(entry[0]) for entry in entries] == [tuple(row) for row in result_boxes(entries).tolist()], entries
+        boxes1 = [box() for _ in range(rng.randint(1, 8))]
+        boxes2 = [box() for _ in range(rng.randint(1, 40))]
+        loop, arrays = closest_boxes_loop(boxes1, boxes2), closest_boxes_arrays(boxes1, boxes2).tolist()
+        assert loop == arrays, f"closest boxes of {boxes1} among {boxes2}: loop {loop}, arrays {arrays}"
+    print(f"{cases} closest box cases agree")
+
+#per-page time of table caption matching, the old first-corner loop vs the box distances (a python loop
+#below tablecaption.VECTORIZED_MIN_PAIRS, arrays above it); checks the two paths agree first
+def bench_captions(args):
+    from tablecaption import find_closest_results_for_table_caption
+
+    check_closest_boxes()
+    for lines in args.lines:
+        data = synthetic_table_response(lines, args.tables)
+        timings = {}
+        for name, func in (("loop", legacy_table_captions), ("boxes", find_closest_results_for_table_caption)):
+            start_time = time.perf_counter()
+            for _ in range(args.repeat):
+                func(data)
+            timings[name] = (time.perf_counter() - start_time) / args.repeat
+        print(f"{lines:>6} lines, {args.tables} tables: loop {timings['loop'] * 1000:8.2f} ms   "
+              f"boxes {timings['boxes'] * 1000:8.2f} ms   speedup {timings['loop'] / timings['boxes']:6.1f}x")
+
+#html table like the OCR service returns, with header row, inline markup, entities and spanning cells
+def synthetic_table_html(rows, columns, seed=0):
+    rng = random.Random(seed)
+    html = ["<html><body><table><thead><tr>"]
+    html.extend(f"<td>Column {column}</td>" for column in range(columns))
+    html.append("</tr></thead><tbody>")
+    for row in range(rows):
+        html.append("<tr>")
+        column = 0
+        while column < columns:
+            value = f"{rng.uniform(-1e6, 1e6):,.2f}"
+            if rng.random() < 0.05 and column + 1 < columns:
+                html.append(f'<td colspan="2"> <b>Total</b> {value} </td>')
+                column += 2
+                continue
+            cell = rng.choice([value, f"<b>{value}</b>", f"{value}&nbsp;%", f" ({value})<br/>", ""])
+            html.append(f'<td rowspan="2">{cell}</td>' if rng.random() < 0.02 else f"<td>{cell}</td>")
+            column += 1
+        html.append("</tr>")
+    html.append("</tbody></table></body></html>")
+    return "".join(html)
+
+#old table parser: a full BeautifulSoup tree with the python html.parser
+def legacy_parse_html_table(html):
+    from bs4 import BeautifulSoup
+
+    table = BeautifulSoup(html, 'html.parser').find('table')
+    return [[cell.get_text(strip=True) for cell in row.find_all(['td', 'th'])] for row in table.find_all('tr')]
+
+# (html, rows parse_table must give, whether BeautifulSoup gives the same rows) for the cases the
+# parsers are known to agree or differ on, see tablecaption.parse_table
+TABLE_HTML_CASES = [
+    ("<table><tr><td>a</td><td>b</td></tr><tr><td>c</td></tr></table>", [["a", "b"], ["c"]], True),
+    ("<table><tr><th>h</th></tr><tr><td>x<!-- note -->y</td></tr></table>", [["h"], ["xy"]], True),
+    ("<html><body><table><tr><td> a &amp; b&nbsp;c </td><td>d<br/>e</td></tr></table></body></html>", [["a & b\xa0c", "de"]], True),
+    ("<table><tr><td><b>1</b> 2</td></tr></table><table><tr><td>other</td></tr></table>", [["12"]], True),
+    ('<table><tr><td rowspan="2">a</td><td colspan="x">b</td></tr><tr><td>c</td></tr></table>', [["a", "b"], ["c"]], True),
+    ("<table><tr><td>a<td>b<tr><td>c</table>", [["a", "b"], ["c"]], False),
+    ('<?xml version="1.0" encoding="utf-8"?><table><tr><td>a</td></tr></table>', [["a"]], True),
+    ("<p>no table</p>", [], False),
+    ("", [], False),
+]
+
+#assert parse_table's rows for TABLE_HTML_CASES, and BeautifulSoup's where they must agree
+def check_table_html():
+    import warnings
+    from tablecaption import parse_table
+
+    for html, expected, same_as_legacy in TABLE_HTML_CASES:
+        rows = parse_table(html)[0]
+        assert rows == expected, f"parse_table({html!r}) gave {rows}, expected {expected}"
+        if same_as_legacy:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                legacy = legacy_parse_html_table(html)
+            assert rows == legacy, f"parse_table({html!r}) gave {rows}, BeautifulSoup {legacy}"
+    print(f"{len(TABLE_HTML_CASES)} table html cases pass")
+
+#rows of the lxml table parser against the BeautifulSoup one, and the time of both; fails when any
+#table's rows differ
+def bench_table_html(args):
+    import glob
+    from tablecaption import parse_table
+
+    check_table_html()
+    tables = [(f"synthetic {rows}x{args.columns}", synthetic_table_html(rows, args.columns, seed=rows)) for rows in args.rows]
+    for path in sorted(glob.glob(os.path.join(args.recordings, "*.json"))) if args.recordings else []:
+        with open(path) as f:
+            tables.extend((os.path.basename(path), layout_obj["res"]["html"])
+                          for layout_obj in json.load(f)["layout"] if layout_obj["type"] == "table")
+
+    mismatches = 0
+    legacy_time = fast_time = 0.0
+    for name, html in tables:
+        start_time = time.perf_counter()
+        for _ in range(args.repeat):
+            expected = legacy_parse_html_table(html)
+        legacy_time += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for _ in range(args.repeat):
+            rows, spans = parse_table(html)
+        fast_time += time.perf_counter() - start_time
+        if rows != expected:
+            mismatches += 1
+            print(f"{name}: rows differ from the BeautifulSoup parser")
+        if args.verbose:
+            print(f"{name}: {len(rows)} rows, {len(spans)} spanning cells")
+    print(f"{len(tables)} tables, {mismatches} differ")
+    print(f"html.parser {legacy_time * 1000 / args.repeat:9.1f} ms   lxml {fast_time * 1000 / args.repeat:9.1f} ms   "
+          f"speedup {legacy_time / max(fast_time, 1e-9):.1f}x")
+    if mismatches:
+        raise SystemExit(f"{mismatches} of {len(tables)} tables differ from the BeautifulSoup parser")
+
+#seconds a fresh interpreter in `folder` takes to run `code`, median over `repeat` runs
+def time_subprocess(code, folder, repeat):
+    import subprocess
+    import sys
+
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], cwd=folder, capture_output=True, text=True, check=True).stdout
+        timings.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: statistics.median(timing[key] for timing in timings) for key in timings[0]}
+
+IMPORT_CODE = """
+import json, time
+start_time = time.perf_counter()
+import process_pdf
+print(json.dumps({"import": time.perf_counter() - start_time}))
+"""
+
+FIRST_PAGE_CODE = """
+import json, time
+start_time = time.perf_counter()
+import process_pdf
+imported = time.perf_counter()
+if process_pdf.PRELOAD_MODELS:
+    process_pdf.warm_up_models()
+warmed = time.perf_counter()
+process_pdf.process_page_batch({pdf!r}, [0], "startup", "startup")
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start_time, "warm_up": warmed - imported, "first_page": done - warmed, "total": done - start_time}}))
+"""
+
+#import time of process_pdf, and the time from a cold start to the first processed page; with --ref
+#the import time of that git revision is measured too, from a temporary worktree
+def bench_startup(args):
+    import subprocess
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    print(f"import process_pdf:   {time_subprocess(IMPORT_CODE, folder, args.repeat)['import']:8.3f} s (this tree)")
+    if args.ref:
+        with tempfile.TemporaryDirectory() as worktree:
+            subprocess.run(["git", "worktree", "add", "--detach", worktree, args.ref], cwd=folder, check=True, capture_output=True)
+            try:
+                print(f"import process_pdf:   {time_subprocess(IMPORT_CODE, worktree, args.repeat)['import']:8.3f} s ({args.ref})")
+            finally:
+                subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=folder, check=True)
+    if args.pdf:
+        timing = time_subprocess(FIRST_PAGE_CODE.format(pdf=os.path.abspath(args.pdf)), folder, args.repeat)
+        print(f"first page: import {timing['import']:.3f} s, model warm-up {timing['warm_up']:.3f} s, "
+              f"page {timing['first_page']:.3f} s, total {timing['total']:.3f} s")
+
+#area overlap of two (x1, y1, x2, y2) rectangles over their union
+def box_iou(a, b):
+    width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - width * height
+    return width * height / union if union > 0 else 0.0
+
+#render + detect latency and page pixels held when detecting on the layout render against detecting
+#on a low resolution render (each page's detect_settings, --detect-dpi as the floor) and rendering
+#only the block crops at the layout resolution. The pages are followed by the first one shrunk onto a
+#6x9 in trim, which needs more than the floor to reach the model's input size
+def bench_resolution(args):
+    import fitz
+    import process_pdf
+    from page_text import crop_block
+
+    process_pdf.RENDER_SETTINGS["detect"]["dpi"] = args.detect_dpi
+    process_pdf.RENDER_SETTINGS["layout"]["dpi"] = args.layout_dpi
+    document = fitz.open(args.pdf)
+    trim = document.new_page(width=6 * 72, height=9 * 72)
+    trim.show_pdf_page(trim.rect, fitz.open(args.pdf), 0)
+    pages = [document[page_num] for page_num in range(min(args.pages, len(document) - 1))] + [document[-1]]
+    print("detect dpi per page:", [process_pdf.detect_settings(page)["dpi"] for page in pages])
+    process_pdf.warm_up_models()
+    results = {}
+    for name in ("full page", "multi-res"):
+        timings, held, layouts = [], [], []
+        for page in pages:
+            detect_dpi = args.layout_dpi if name == "full page" else process_pdf.detect_settings(page)["dpi"]
+            start_time = time.perf_counter()
+            image = process_pdf.render_page(page, detect_dpi)
+            layout = process_pdf.scale_layout(process_pdf.detect_layouts([image])[0], args.layout_dpi / detect_dpi)
+            regions = image if detect_dpi == args.layout_dpi else process_pdf.PageRegions(page, args.layout_dpi)
+            crops = [crop_block(regions, block) for block in layout]
+            timings.append(time.perf_counter() - start_time)
+            # the render the handlers crop from stays alive for the whole page, a region only while it is used
+            held.append(image.nbytes + (max((crop.nbytes for crop in crops), default=0) if regions is not image else 0))
+            layouts.append([(block.type, block.block.x_1, block.block.y_1, block.block.x_2, block.block.y_2) for block in layout])
+        results[name] = layouts
+        report(name, timings)
+        print(f"{'':12} pixels held per page: mean {statistics.mean(held) / 2**20:.1f} MiB, max {max(held) / 2**20:.1f} MiB")
+
+    matched, total = [], 0
+    for full_layout, multi_layout in zip(results["full page"], results["multi-res"]):
+        total += len(full_layout)
+        for block in full_layout:
+            candidates = [box_iou(block[1:], other[1:]) for other in multi_layout if other[0] == block[0]]
+            matched.append(max(candidates, default=0.0))
+    print(f"blocks: {total} at {args.layout_dpi} dpi, {sum(map(len, results['multi-res']))} at the detect dpi, "
+          f"mean best IoU {statistics.mean(matched) if matched else 1.0:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro benchmarks for the book processing pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    crops = commands.add_parser("crops", help="per-page latency of file based vs in-memory block crops")
+    crops.add_argument("--image", help="page image to crop; a synthetic 2550x3300 page is used when omitted")
+    crops.add_argument("--blocks", type=int, default=30)
+    crops.add_argument("--pages", type=int, default=5)
+    crops.add_argument("--ocr", action="store_true", help="include the tesseract call for every block")
+    crops.set_defaults(func=bench_crops)
+
+    detect = commands.add_parser("detect-batch", help="layout detection throughput per batch size")
+    detect.add_argument("pdf")
+    detect.add_argument("--pages", type=int, default=16)
+    detect.add_argument("--dpi", type=int, default=300)
+    detect.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    detect.set_defaults(func=bench_detect_batch)
+
+    accuracy = commands.add_parser("ocr-accuracy", help="per-page vs per-block tesseract text and cost")
+    accuracy.add_argument("pdfs", nargs="+")
+    accuracy.add_argument("--pages", type=int, default=10, help="pages per pdf")
+    accuracy.add_argument("--dpi", type=int, default=300)
+    accuracy.set_defaults(func=bench_ocr_accuracy)
+
+    captions = commands.add_parser("captions", help="table caption matching over synthetic OCR responses")
+    captions.add_argument("--lines", type=int, nargs="+", default=[100, 500, 1000, 2500, 5000])
+    captions.add_argument("--tables", type=int, default=4)
+    captions.add_argument("--repeat", type=int, default=20)
+    captions.set_defaults(func=bench_captions)
+
+    table_html = commands.add_parser("table-html", help="lxml vs BeautifulSoup table parsing, rows must match")
+    table_html.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000])
+    table_html.add_argument("--columns", type=int, default=8)
+    table_html.add_argument("--recordings", help="folder of recorded OCR responses (see table_ocr_stub.py) to check too")
+    table_html.add_argument("--repeat", type=int, default=5)
+    table_html.add_argument("--verbose", action="store_true")
+    table_html.set_defaults(func=bench_table_html)
+
+    startup = commands.add_parser("startup", help="process_pdf import time and time to the first page")
+    startup.add_argument("--pdf", help="book whose first page is processed from a cold start")
+    startup.add_argument("--ref", help="git revision to compare the import time against, e.g. HEAD~1")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    resolution = commands.add_parser("resolution", help="detection on a low resolution render vs the layout render")
+    resolution.add_argument("pdf")
+    resolution.add_argument("--pages", type=int, default=10)
+    resolution.add_argument("--detect-dpi", type=int, default=100, help="floor of the per-page detection dpi")
+    resolution.add_argument("--layout-dpi", type=int, default=300)
+    resolution.set_defaults(func=bench_resolution)
+
+    args = parser.parse_args()
+    args.func(args)
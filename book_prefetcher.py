@@ -0,0 +1,55 @@
+import queue
+import threading
+
+# Downloads upcoming books into memory on a background thread while the current one is processed.
+# Books are yielded in order as (url, pdf_bytes, error). The bytes of every book downloaded but
+# not yet finished count against max_bytes; the next download waits until it fits (a single book
+# larger than the budget is still fetched once nothing else is held). A book's bytes are released
+# when the consumer asks for the next book.
+class BookPrefetcher:
+    def __init__(self, s3_client, urls, locate, max_bytes=1024 ** 3):
+        self.s3 = s3_client
+        self.urls = urls
+        self.locate = locate
+        self.max_bytes = max_bytes
+        self.held_bytes = 0
+        self.budget = threading.Condition()
+        self.books = queue.Queue()
+        self.thread = threading.Thread(target=self._download_all, name="book-prefetch", daemon=True)
+        self.thread.start()
+
+    def _download_all(self):
+        for url in self.urls:
+            try:
+                bucket_name, file_key = self.locate(url)
+                size = self.s3.head_object(Bucket=bucket_name, Key=file_key)["ContentLength"]
+                self._reserve(size)
+                try:
+                    pdf_bytes = self.s3.get_object(Bucket=bucket_name, Key=file_key)["Body"].read()
+                except Exception:
+                    self._release(size)
+                    raise
+                self.books.put((url, pdf_bytes, None))
+            except Exception as e:
+                self.books.put((url, None, e))
+        self.books.put(None)
+
+    def _reserve(self, size):
+        with self.budget:
+            while self.held_bytes and self.held_bytes + size > self.max_bytes:
+                self.budget.wait()
+            self.held_bytes += size
+
+    def _release(self, size):
+        with self.budget:
+            self.held_bytes -= size
+            self.budget.notify_all()
+
+    def __iter__(self):
+        while True:
+            book = self.books.get()
+            if book is None:
+                return
+            yield book
+            if book[1] is not None:
+                self._release(len(book[1]))
@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+import fitz
+
+# End-to-end throughput of process_pdf.py without any of its remote services: synthetic books with
+# known text, tables, figures and equations are served from an in-process S3 (moto), pages go to
+# mongomock (or a local mongod), table crops to table_ocr_stub.py, and with --stub-models the layout
+# models and nougat answer from the books' ground truth instead of loading their weights.
+#
+#   python e2e_benchmark.py --books 2 --pages 12 --stub-models --save results.json
+#   python e2e_benchmark.py --books 2 --pages 12 --stub-models --baseline results.json --threshold 0.15
+
+BUCKET = "bench-books"
+FOLDER = "bench-set"
+DATABASE = "pipeline_benchmark"
+# stages reported and compared against the baseline, besides the pages/sec of the whole run
+REPORTED_STAGES = ("process_book", "process_page", "process_image", "sort_text_blocks_and_extract_data",
+                   "render", "detect", "ocr", "table_ocr", "nougat", "upload", "db_write")
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do",
+         "eiusmod", "tempor", "incididunt", "labore", "magna", "aliqua", "table", "figure", "result"]
+PAGE_KINDS = ("text", "table", "figure", "equation")
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+#write a text block and return its ground truth entry
+def add_text(page, rng, rect, block_type="Text", fontsize=11, text=None):
+    if text is None:
+        text = sentence(rng, 4) if block_type == "Title" else " ".join(sentence(rng, 12) for _ in range(4))
+    page.insert_textbox(rect, text, fontsize=fontsize, fontname="helv")
+    return {"type": block_type, "rect": list(rect), "text": text}
+
+def add_table(page, rng, rect, rows=5, columns=4):
+    cell_width, cell_height = rect.width / columns, rect.height / rows
+    table = [[f"Col {column}" for column in range(columns)]]
+    table += [[f"{rng.uniform(0, 1000):.2f}" for _ in range(columns)] for _ in range(rows - 1)]
+    for row, values in enumerate(table):
+        for column, value in enumerate(values):
+            cell = fitz.Rect(rect.x0 + column * cell_width, rect.y0 + row * cell_height,
+                             rect.x0 + (column + 1) * cell_width, rect.y0 + (row + 1) * cell_height)
+            page.draw_rect(cell, color=(0, 0, 0), width=0.5)
+            page.insert_textbox(cell + (4, 4, -4, -4), value, fontsize=10, fontname="helv")
+    return {"type": "Table", "rect": list(rect), "rows": table}
+
+def add_figure(page, rng, rect):
+    page.draw_rect(rect, color=(0, 0, 0), width=1)
+    for _ in range(12):
+        x, y = rng.uniform(rect.x0, rect.x1 - 40), rng.uniform(rect.y0, rect.y1 - 40)
+        color = (rng.random(), rng.random(), rng.random())
+        page.draw_rect(fitz.Rect(x, y, x + rng.uniform(10, 40), y + rng.uniform(10, 40)), color=color, fill=color)
+    return {"type": "Figure", "rect": list(rect)}
+
+#one synthetic page of the given kind and its ground truth (blocks in points, nougat markdown)
+def synthetic_page(document, rng, kind, number):
+    page = document.new_page(width=612, height=792)
+    blocks = [add_text(page, rng, fitz.Rect(72, 60, 540, 90), "Title", fontsize=16),
+              add_text(page, rng, fitz.Rect(72, 100, 540, 210))]
+    markdown = [f"# {blocks[0]['text']}", blocks[1]["text"]]
+    if kind == "table":
+        blocks.append(add_text(page, rng, fitz.Rect(72, 224, 540, 250), text=f"Table {number}: synthetic results"))
+        blocks.append(add_table(page, rng, fitz.Rect(72, 252, 540, 452)))
+    elif kind == "figure":
+        blocks.append(add_figure(page, rng, fitz.Rect(120, 230, 492, 450)))
+        blocks.append(add_text(page, rng, fitz.Rect(72, 460, 540, 500), text=f"Figure {number}. Synthetic plot of {sentence(rng, 4)}"))
+    elif kind == "equation":
+        equations = [f"x_{{{number}}}^2 + y^2 = z^{{{number + 2}}}", f"\\sum_{{i=1}}^{{{number}}} i = \\frac{{{number}({number}+1)}}{{2}}"]
+        for offset, latex in enumerate(equations):
+            page.insert_textbox(fitz.Rect(150, 240 + 40 * offset, 462, 270 + 40 * offset), latex, fontsize=12, fontname="cour")
+        markdown += [f"\\[{latex}\\]" for latex in equations]
+    blocks.append(add_text(page, rng, fitz.Rect(72, 520, 540, 700)))
+    markdown.append(blocks[-1]["text"])
+    return {"kind": kind, "blocks": blocks, "markdown": "\n\n".join(markdown)}
+
+#pdf bytes of a synthetic book cycling through the page kinds, and its per page ground truth
+def synthetic_book(pages, seed):
+    rng = random.Random(seed)
+    document = fitz.open()
+    truth = [synthetic_page(document, rng, PAGE_KINDS[number % len(PAGE_KINDS)], number + 1) for number in range(pages)]
+    pdf_bytes = document.tobytes()
+    document.close()
+    return pdf_bytes, truth
+
+#recorded response for every table crop: one table with its caption
+def write_table_recording(folder):
+    html = "<html><body><table>" + "".join(
+        "<tr>" + "".join(f"<td>{row}.{column}</td>" for column in range(4)) + "</tr>" for row in range(5)) + "</table></body></html>"
+    response = {
+        "layout": [{"type": "table_caption", "bbox": [0, 0, 600, 40]},
+                   {"type": "table", "bbox": [0, 60, 1400, 900], "res": {"html": html}}],
+        "result": [[[[[5, 5], [595, 5], [595, 35], [5, 35]], ["Table 1: synthetic results", 0.99]]]],
+    }
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "default.json"), "w") as f:
+        json.dump(response, f)
+
+# Layout model answering with the ground truth blocks of the pages it was shown at render time
+class StubModelLoader:
+    layouts = {}
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    @classmethod
+    def warm_up(cls, model_names=("PubLayNet", "TableBank")):
+        pass
+
+    @property
+    def model(self):
+        return self
+
+    @staticmethod
+    def key(image):
+        from result_cache import content_digest
+        return content_digest(image[..., 0] if image.ndim == 3 else image)
+
+    def detect(self, image):
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images):
+        from process_pdf import records_to_layout
+        layouts = []
+        for image in images:
+            records = self.layouts.get(self.key(image), [])
+            if self.model_name == "TableBank":
+                records = [record for record in records if record[0] == "Table"]
+            layouts.append(records_to_layout(records))
+        return layouts
+
+# Nougat answering with the ground truth markdown of each page number
+class StubNougatEngine:
+    markdown = {}
+
+    def __init__(self, model_tag=None, batch_size=None):
+        pass
+
+    def predict(self, images, page_numbers=None):
+        page_numbers = range(len(images)) if page_numbers is None else page_numbers
+        return [self.markdown.get(page_num, "") for page_num in page_numbers]
+
+    def predict_pdf(self, pdf_path, num_pages, chunk_size=32):
+        return self.predict([None] * num_pages)
+
+#point the layout/nougat stubs at the books' ground truth, rendering every page the way the pipeline does
+def install_stub_models(process_pdf, books):
+    for pdf_bytes, truth in books:
+        document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        for page, page_truth in zip(document, truth):
+            settings = process_pdf.detect_settings(page)
+            scale = settings["dpi"] / 72
+            # the undecorated render keeps this setup out of the run's render metrics
+            render_page = getattr(process_pdf.render_page, "__wrapped__", process_pdf.render_page)
+            image = render_page(page, **settings)
+            StubModelLoader.layouts[StubModelLoader.key(image)] = [
+                (block["type"], *[value * scale for value in block["rect"]], 0.99) for block in page_truth["blocks"]]
+            StubNougatEngine.markdown[page.number] = page_truth["markdown"]
+        document.close()
+    # process_pdf imports the model modules when it first needs them, these take their place
+    sys.modules["model_loader"] = types.SimpleNamespace(ModelLoader=StubModelLoader)
+    sys.modules["nougat_engine"] = types.SimpleNamespace(NougatEngine=StubNougatEngine)
+
+#environment for importing process_pdf against the local stand-ins
+def configure_environment(args, folder, table_ocr_url):
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_SESSION_TOKEN": "testing",
+        "AWS_REGION": "us-east-1", "AWS_DEFAULT_REGION": "us-east-1", "AWS_BUCKET_NAME": BUCKET,
+        "DATABASE_URL": args.mongo_url or "mongodb://localhost:27017", "DATABASE_NAME": DATABASE,
+        "TABLE_OCR_URL": table_ocr_url,
+        "METRICS_ENABLED": "1", "METRICS_DIR": os.path.join(folder, "metrics"),
+        "METRICS_REPORT": os.path.join(folder, "metrics_report.json"),
+        "PAGE_WORKERS": str(args.workers), "DETECT_BATCH_SIZE": str(args.batch_size),
+        "RESULT_CACHE_DIR": "", "SPEECH_CACHE_DIR": "", "PAGE_RESUME": "0",
+    })
+
+def run(args):
+    import table_ocr_stub
+
+    books = [synthetic_book(args.pages, seed) for seed in range(args.books)]
+    with tempfile.TemporaryDirectory() as folder:
+        write_table_recording(os.path.join(folder, "recordings"))
+        stub = table_ocr_stub.serve(os.path.join(folder, "recordings"), latency=args.table_latency)
+        configure_environment(args, folder, stub.url)
+        if not args.mongo_url:
+            import mongomock
+            import pymongo
+            pymongo.MongoClient = mongomock.MongoClient
+        try:
+            from moto import mock_aws
+        except ImportError:
+            from moto import mock_s3 as mock_aws
+        with mock_aws():
+            import process_pdf
+            import metrics
+
+            # a database of its own, never the pipeline's, even on a local mongod
+            db = process_pdf.get_db()
+            db.client.drop_database(DATABASE)
+            s3 = process_pdf.get_s3()
+            s3.create_bucket(Bucket=BUCKET)
+            urls = []
+            for index, (pdf_bytes, truth) in enumerate(books):
+                key = f"{FOLDER}/synthetic-{index}.pdf"
+                s3.put_object(Bucket=BUCKET, Key=key, Body=pdf_bytes)
+                urls.append(process_pdf.book_url(BUCKET, key))
+            if args.stub_models:
+                install_stub_models(process_pdf, books)
+
+            start_time = time.perf_counter()
+            process_pdf.process_books(urls)
+            total_time = time.perf_counter() - start_time
+            stored = db.bookpages.count_documents({})
+            errors = [{key: value for key, value in doc.items() if key != "_id"} for doc in db.error_collection.find()]
+            report = metrics.collect(os.environ["METRICS_DIR"]).report()
+        stub.shutdown()
+
+    pages = args.books * args.pages
+    return {
+        "config": {"books": args.books, "pages": args.pages, "workers": args.workers, "batch_size": args.batch_size,
+                   "stub_models": args.stub_models, "table_latency": args.table_latency},
+        "pages": pages,
+        "stored_pages": stored,
+        "error_documents": len(errors),
+        "errors": errors[:5],
+        "seconds": round(total_time, 4),
+        "pages_per_sec": round(pages / total_time, 4),
+        "stages": {stage: report["stages"][stage] for stage in REPORTED_STAGES if stage in report["stages"]},
+        "counters": report["counters"],
+    }
+
+def print_results(results):
+    print(f"{results['pages']} pages ({results['stored_pages']} stored, {results['error_documents']} error documents) "
+          f"in {results['seconds']:.2f} s: {results['pages_per_sec']:.2f} pages/sec")
+    print(f"{'stage':<36}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p95 ms':>10}")
+    for stage, summary in results["stages"].items():
+        print(f"{stage:<36}{summary['count']:>8}{summary['seconds']:>10.3f}{summary['mean'] * 1000:>10.2f}{summary['p95'] * 1000:>10.2f}")
+    for error in results["errors"]:
+        print("error:", json.dumps(error, default=str)[:300])
+
+#regressions of the run against a saved one: pages/sec down, or a stage's mean time up, by more than threshold
+def regressions(results, baseline, threshold, min_seconds=0.001):
+    found = []
+    if results["pages_per_sec"] < baseline["pages_per_sec"] * (1 - threshold):
+        found.append(f"pages/sec {baseline['pages_per_sec']:.2f} -> {results['pages_per_sec']:.2f}")
+    for stage, summary in results["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before and before["mean"] >= min_seconds and summary["mean"] > before["mean"] * (1 + threshold):
+            found.append(f"{stage} mean {before['mean'] * 1000:.2f} ms -> {summary['mean'] * 1000:.2f} ms")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark on synthetic books with local stand-ins")
+    parser.add_argument("--books", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=12, help="pages per book")
+    parser.add_argument("--workers", type=int, default=1, help="PAGE_WORKERS of the run")
+    parser.add_argument("--batch-size", type=int, default=1, help="DETECT_BATCH_SIZE of the run")
+    parser.add_argument("--stub-models", action="store_true", help="ground truth layouts and nougat output instead of the models")
+    parser.add_argument("--table-latency", type=float, default=0.0, help="seconds the table OCR stand-in takes per crop")
+    parser.add_argument("--mongo-url", help="use this mongod instead of mongomock")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative slowdown before a regression is flagged")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        for regression in found:
+            print("REGRESSION:", regression)
+        sys.exit(1 if found else 0)
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import metrics
+
+# Admits work while the estimated bytes of everything admitted and not yet released fit in
+# max_bytes (no limit when 0). Something larger than the whole budget is still admitted once
+# nothing else is in flight, so it runs alone instead of never. Keeps the current and peak
+# in-flight bytes for the report.
+class MemoryBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.peak = 0
+        self.admitted = 0
+        self.waits = 0
+        self.waited_seconds = 0.0
+
+    def _fits(self, size):
+        return not self.max_bytes or not self.in_flight or self.in_flight + size <= self.max_bytes
+
+    # block until `size` bytes fit, then count them as in flight; gives up and returns False once
+    # `cancelled()` is true, so a consumer that stopped releasing does not leave the caller waiting
+    def reserve(self, size, cancelled=None):
+        with self.condition:
+            if not self._fits(size):
+                self.waits += 1
+                start_time = time.perf_counter()
+                try:
+                    while not self._fits(size):
+                        if cancelled is not None and cancelled():
+                            return False
+                        self.condition.wait(0.1 if cancelled is not None else None)
+                finally:
+                    waited = time.perf_counter() - start_time
+                    self.waited_seconds += waited
+                    metrics.count("memory_budget:waited_seconds", waited)
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+            self.admitted += 1
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+    #hand the items out one at a time, each once its size fits, until cancelled
+    def admit(self, items, sizes, cancelled=None):
+        for item, size in zip(items, sizes):
+            if not self.reserve(size, cancelled):
+                return
+            yield item
+
+    def stats(self):
+        with self.condition:
+            return {"max_bytes": self.max_bytes, "in_flight_bytes": self.in_flight, "peak_bytes": self.peak,
+                    "admitted": self.admitted, "waits": self.waits, "waited_seconds": round(self.waited_seconds, 3)}
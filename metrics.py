@@ -0,0 +1,306 @@
+import argparse
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# stage latencies are only recorded with METRICS_ENABLED=1, otherwise the decorators hand back the
+# undecorated function. Every process drops its snapshot into METRICS_DIR, the run report and the
+# Prometheus endpoint (METRICS_PORT, off when 0) add them all up.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR', '.metrics')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_REPORT = os.environ.get('METRICS_REPORT', 'metrics_report.json')
+# pages whose stage seconds a process keeps for the report, the oldest are dropped past it
+METRICS_MAX_PAGES = int(os.environ.get('METRICS_MAX_PAGES', 1000))
+
+# upper bounds in seconds of the latency histogram buckets, from 1 ms to 10 minutes
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 600)
+
+# book and page the current code is working on, copied onto the observations made under it
+_tags = contextvars.ContextVar("metric_tags", default={})
+_disabled = nullcontext()
+
+# Latency histogram with fixed buckets, mergeable across processes
+class Histogram:
+    def __init__(self, counts=None, total=0.0, maximum=0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.total = total
+        self.maximum = maximum
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    #upper bound of the bucket holding the q-th quantile
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (self.maximum,), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        count = self.count
+        return {"count": count, "seconds": round(self.total, 6), "mean": round(self.total / max(count, 1), 6),
+                "p50": round(self.quantile(0.5), 6), "p95": round(self.quantile(0.95), 6), "p99": round(self.quantile(0.99), 6),
+                "max": round(self.maximum, 6)}
+
+    def to_dict(self):
+        return {"counts": self.counts, "total": self.total, "maximum": self.maximum}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(list(data["counts"]), data["total"], data["maximum"])
+
+# Stage histograms per book, event counters per book and stage seconds of the last max_pages pages
+# of one process
+class Metrics:
+    def __init__(self, max_pages=METRICS_MAX_PAGES):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.pages = {}
+        self.max_pages = max_pages
+
+    def observe(self, stage, seconds):
+        tags = _tags.get()
+        book, page = tags.get("book", ""), tags.get("page")
+        with self.lock:
+            histogram = self.histograms.get((stage, book))
+            if histogram is None:
+                histogram = self.histograms[(stage, book)] = Histogram()
+            histogram.observe(seconds)
+            if page is not None:
+                page_stages = self.pages.setdefault((book, page), {})
+                page_stages[stage] = page_stages.get(stage, 0.0) + seconds
+                if len(self.pages) > self.max_pages:
+                    del self.pages[next(iter(self.pages))]
+
+    def count(self, name, value=1):
+        book = _tags.get().get("book", "")
+        with self.lock:
+            self.counters[(name, book)] = self.counters.get((name, book), 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "histograms": [[stage, book, histogram.to_dict()] for (stage, book), histogram in self.histograms.items()],
+                "counters": [[name, book, value] for (name, book), value in self.counters.items()],
+                "pages": [[book, page, dict(stages)] for (book, page), stages in self.pages.items()],
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for stage, book, data in snapshot["histograms"]:
+                histogram = self.histograms.setdefault((stage, book), Histogram())
+                histogram.merge(Histogram.from_dict(data))
+            for name, book, value in snapshot["counters"]:
+                self.counters[(name, book)] = self.counters.get((name, book), 0) + value
+            for book, page, stages in snapshot["pages"]:
+                page_stages = self.pages.setdefault((book, page), {})
+                for stage, seconds in stages.items():
+                    page_stages[stage] = page_stages.get(stage, 0.0) + seconds
+
+    # per stage summaries over every book, per book and per page, and the counters
+    def report(self):
+        stages = {}
+        for (stage, book), histogram in self.histograms.items():
+            stages.setdefault(stage, Histogram()).merge(histogram)
+        books = {}
+        for (stage, book), histogram in self.histograms.items():
+            books.setdefault(book, {})[stage] = histogram.summary()
+        counters = {}
+        for (name, book), value in self.counters.items():
+            counters[name] = counters.get(name, 0) + value
+        return {
+            "stages": {stage: histogram.summary() for stage, histogram in sorted(stages.items())},
+            "books": books,
+            "counters": counters,
+            "pages": [{"book": book, "page": page, "stages": {stage: round(seconds, 6) for stage, seconds in stages.items()}}
+                      for (book, page), stages in sorted(self.pages.items(), key=lambda item: (item[0][0], item[0][1]))],
+        }
+
+    # Prometheus text exposition format; series are per stage and event only, a label per book would
+    # grow without bound over a corpus
+    def prometheus(self):
+        stages = {}
+        for (stage, book), histogram in self.histograms.items():
+            stages.setdefault(stage, Histogram()).merge(histogram)
+        counters = {}
+        for (name, book), value in self.counters.items():
+            counters[name] = counters.get(name, 0) + value
+        lines = ["# HELP pipeline_stage_seconds Latency of the book processing stages",
+                 "# TYPE pipeline_stage_seconds histogram"]
+        for stage, histogram in sorted(stages.items()):
+            labels = f'stage="{escape_label(stage)}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'pipeline_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'pipeline_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'pipeline_stage_seconds_sum{{{labels}}} {histogram.total}')
+            lines.append(f'pipeline_stage_seconds_count{{{labels}}} {histogram.count}')
+        lines += ["# HELP pipeline_events_total Counted pipeline events",
+                  "# TYPE pipeline_events_total counter"]
+        for name, value in sorted(counters.items()):
+            lines.append(f'pipeline_events_total{{name="{escape_label(name)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+_metrics = None
+
+#metrics of this process; a forked worker starts from empty ones so nothing is counted twice
+def get_metrics():
+    global _metrics
+    if _metrics is None or _metrics[0] != os.getpid():
+        _metrics = (os.getpid(), Metrics())
+    return _metrics[1]
+
+#decorator recording the function's latency under `stage` (default: its name)
+def timed(stage=None):
+    def decorate(func):
+        if not METRICS_ENABLED:
+            return func
+        name = stage or func.__name__
+
+        @wraps(func)
+        def timed_wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                get_metrics().observe(name, time.perf_counter() - start_time)
+        return timed_wrapper
+    return decorate
+
+#record the latency of a with block under `stage`
+def measure(stage):
+    if not METRICS_ENABLED:
+        return _disabled
+    return _measure(stage)
+
+@contextmanager
+def _measure(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_metrics().observe(stage, time.perf_counter() - start_time)
+
+#tag the observations made in a with block with the book and/or page
+def tagged(**tags):
+    if not METRICS_ENABLED:
+        return _disabled
+    return _tagged(tags)
+
+@contextmanager
+def _tagged(tags):
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+def count(name, value=1):
+    if METRICS_ENABLED:
+        get_metrics().count(name, value)
+
+#write this process' snapshot where the report and the endpoint pick it up
+def flush(folder=METRICS_DIR):
+    if not METRICS_ENABLED:
+        return
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"metrics-{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(get_metrics().snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+#the snapshots of every process in the folder added up
+def collect(folder=METRICS_DIR):
+    merged = Metrics()
+    for path in glob.glob(os.path.join(folder, "metrics-*.json")):
+        try:
+            with open(path) as f:
+                merged.merge(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return merged
+
+#forget the snapshots of earlier runs, a run report starts from this
+def clear(folder=METRICS_DIR):
+    for path in glob.glob(os.path.join(folder, "metrics-*.json")):
+        os.remove(path)
+
+def write_report(path=METRICS_REPORT, folder=METRICS_DIR):
+    flush(folder)
+    report = collect(folder).report()
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        flush(self.server.folder)
+        payload = collect(self.server.folder).prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+#serve GET /metrics from a background thread
+def serve_prometheus(port=METRICS_PORT, folder=METRICS_DIR, host="0.0.0.0"):
+    server = ThreadingHTTPServer((host, port), PrometheusHandler)
+    server.daemon_threads = True
+    server.folder = folder
+    threading.Thread(target=server.serve_forever, name="metrics-endpoint", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the stage metrics recorded by the pipeline processes")
+    parser.add_argument("--folder", default=METRICS_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("report", help="write the JSON run report")
+    report.add_argument("--output", default=METRICS_REPORT)
+    serve = commands.add_parser("serve", help="Prometheus text endpoint on /metrics")
+    serve.add_argument("--port", type=int, default=METRICS_PORT or 9100)
+    commands.add_parser("clear", help="forget the snapshots of earlier runs")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        with open(args.output, "w") as f:
+            json.dump(collect(args.folder).report(), f, indent=2)
+        print(f"wrote {args.output}")
+    elif args.command == "serve":
+        serve_prometheus(args.port, args.folder)
+        threading.Event().wait()
+    else:
+        clear(args.folder)
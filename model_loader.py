@@ -1,7 +1,10 @@
 import layoutparser as lp
+import numpy as np
+import torch
 
 class ModelLoader:
     _instances = {}
+    _warm = set()
 
     def __new__(cls, model_name):
         if model_name not in cls._instances:
@@ -36,6 +39,44 @@ class ModelLoader:
     @property
     def model(self):
         return self._model
+
+    # Load the models and run one tiny forward pass through each, so the weights and the lazily
+    # initialized framework state are in place before the first page. Called in a parent process
+    # before it forks page workers, the workers share the loaded weights copy-on-write.
+    @classmethod
+    def warm_up(cls, model_names=("PubLayNet", "TableBank")):
+        for model_name in model_names:
+            if model_name not in cls._warm:
+                cls(model_name).detect_batch([np.full((64, 64, 3), 255, dtype=np.uint8)])
+                cls._warm.add(model_name)
+
+    # Detect the layouts of several images, one forward pass per group of same-sized images.
+    # Mirrors DefaultPredictor.__call__ so every layout matches model.detect(image); detectron2
+    # pads a batch to its largest image, so only images of one shape are batched together.
+    def detect_batch(self, images):
+        predictor = self._model.model
+        layouts = [None] * len(images)
+        groups = {}
+        for index, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(index)
+        with torch.no_grad():
+            for indexes in groups.values():
+                inputs = []
+                for index in indexes:
+                    image = self._model.image_loader(images[index])
+                    if predictor.input_format == "RGB":
+                        image = image[:, :, ::-1]
+                    height, width = image.shape[:2]
+                    resized = predictor.aug.get_transform(image).apply_image(image)
+                    inputs.append({
+                        "image": torch.as_tensor(resized.astype("float32").transpose(2, 0, 1)),
+                        "height": height,
+                        "width": width
+                    })
+                outputs = predictor.model(inputs)
+                for index, output in zip(indexes, outputs):
+                    layouts[index] = self._model.gather_output(output)
+        return layouts
     
 # if __name__ == "__main__":
 #
@@ -0,0 +1,68 @@
+import pypdfium2
+import torch
+from PIL import Image
+from nougat import NougatModel
+from nougat.dataset.rasterize import rasterize_paper
+from nougat.postprocessing import markdown_compatible
+from nougat.utils.checkpoint import get_checkpoint
+from nougat.utils.device import move_to_device
+
+class NougatEngine:
+    _instances = {}
+
+    def __new__(cls, model_tag="0.1.0-small", batch_size=4):
+        if model_tag not in cls._instances:
+            instance = super(NougatEngine, cls).__new__(cls)
+            # Load the checkpoint once per process, the same way the nougat CLI does
+            model = NougatModel.from_pretrained(get_checkpoint(None, model_tag=model_tag))
+            instance._model = move_to_device(model)
+            instance._model.eval()
+            instance.batch_size = batch_size
+            cls._instances[model_tag] = instance
+        return cls._instances[model_tag]
+
+    @property
+    def model(self):
+        return self._model
+
+    # Markdown for each page image, equivalent to `nougat page.pdf --no-skipping` on one page
+    def predict(self, images, page_numbers=None):
+        if page_numbers is None:
+            page_numbers = range(len(images))
+        predictions = []
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            image_tensors = torch.stack([
+                self._model.encoder.prepare_input(self._to_pil(image), random_padding=False) for image in batch
+            ])
+            with torch.no_grad():
+                model_output = self._model.inference(image_tensors=image_tensors, early_stopping=False)
+            for offset, output in enumerate(model_output["predictions"]):
+                predictions.append(self._postprocess(output, page_numbers[start + offset] + 1))
+        return predictions
+
+    # Whole-book mode: rasterize the original PDF (path or bytes) with nougat's own rasterizer and return the
+    # markdown of every page, in page order. rasterize_paper only opens paths itself, bytes are opened here;
+    # it logs a failed render and returns fewer images, which raises so the caller falls back to page batches
+    def predict_pdf(self, pdf, num_pages, chunk_size=32):
+        if isinstance(pdf, (bytes, bytearray)):
+            pdf = pypdfium2.PdfDocument(pdf)
+        predictions = []
+        for start in range(0, num_pages, chunk_size):
+            pages = list(range(start, min(start + chunk_size, num_pages)))
+            images = [Image.open(page_bytes) for page_bytes in rasterize_paper(pdf, return_pil=True, pages=pages)]
+            if len(images) != len(pages):
+                raise ValueError(f"nougat rasterized {len(images)} of pages {pages[0]}-{pages[-1]}")
+            predictions += self.predict(images, pages)
+        return predictions
+
+    @staticmethod
+    def _to_pil(image):
+        return image if isinstance(image, Image.Image) else Image.fromarray(image)
+
+    @staticmethod
+    def _postprocess(output, page_num):
+        if output.strip() == "[MISSING_PAGE_POST]":
+            # uncaught repetitions, most likely an empty page
+            return f"\n\n[MISSING_PAGE_EMPTY:{page_num}]\n\n"
+        return markdown_compatible(output)
@@ -0,0 +1,67 @@
+import numpy as np
+from PIL import Image
+
+#fraction of the page's pixels that are ink (darker than mid gray)
+def ink_coverage(image):
+    gray = image[..., 1] if image.ndim == 3 else image
+    return np.count_nonzero(gray < 128) / max(gray.size, 1)
+
+#difference hash of the page: the page shrunk to size x (size + 1) gray cells, one bit per pair of
+#horizontal neighbours telling whether the right one is brighter
+def page_hash(image, size=32):
+    gray = image[..., 1] if image.ndim == 3 else image
+    cells = np.asarray(Image.fromarray(gray).resize((size + 1, size), Image.BOX), dtype=np.int16)
+    return np.packbits(cells[:, 1:] > cells[:, :-1])
+
+#ink pixels of the page pooled over pool x pool squares and packed, to compare pages pixel by pixel
+def ink_mask(image, pool=2):
+    gray = image[..., 1] if image.ndim == 3 else image
+    height, width = (gray.shape[0] // pool) * pool, (gray.shape[1] // pool) * pool
+    dark = gray[:height, :width] < 128
+    return np.packbits(np.logical_or.reduce([dark[row::pool, column::pool] for row in range(pool) for column in range(pool)]))
+
+def bit_count(packed):
+    return int(np.unpackbits(packed).sum())
+
+# Short-circuits the pages of a book that do not need the models: a page with less than max_ink of
+# its pixels inked is blank, a page whose hash is within max_distance (a fraction of the bits) of a
+# page seen earlier, and whose ink differs from it by at most max_ink_change of the larger ink area,
+# is a duplicate of it (copyright pages, "intentionally left blank", repeated dividers). The hash
+# only finds candidates, the ink comparison keeps pages that merely share a layout (two chapter
+# openers with different titles) apart. The last max_pages distinct pages are remembered, with the
+# page objects they produced once those are in.
+class PageFilter:
+    def __init__(self, max_ink=0.0001, max_distance=0.01, max_ink_change=0.05, max_pages=256):
+        self.max_ink = max_ink
+        self.max_distance = max_distance
+        self.max_ink_change = max_ink_change
+        self.max_pages = max_pages
+        self.seen = []
+        self.results = {}
+
+    # ("blank", None), ("duplicate", page number of the page it repeats) or (None, None); a page
+    # that is neither is remembered under page_num for the pages after it
+    def classify(self, image, page_num):
+        if ink_coverage(image) < self.max_ink:
+            return "blank", None
+        if self.max_distance < 0:
+            return None, None
+        hashed, mask = page_hash(image), ink_mask(image)
+        ink = bit_count(mask)
+        for position in range(len(self.seen) - 1, -1, -1):
+            seen_hash, seen_mask, seen_ink, seen_page = self.seen[position]
+            if seen_mask.shape != mask.shape or bit_count(seen_hash ^ hashed) > self.max_distance * hashed.size * 8:
+                continue
+            if bit_count(seen_mask ^ mask) <= self.max_ink_change * max(ink, seen_ink):
+                # the repeated page becomes the most recent one, it stays remembered until its copies are built
+                self.seen.append(self.seen.pop(position))
+                return "duplicate", seen_page
+        self.seen.append((hashed, mask, ink, page_num))
+        if len(self.seen) > self.max_pages:
+            self.results.pop(self.seen.pop(0)[3], None)
+        return None, None
+
+    #keep the page object of a remembered page for the pages repeating it
+    def remember(self, page_num, page_obj):
+        if any(seen[3] == page_num for seen in self.seen):
+            self.results[page_num] = page_obj
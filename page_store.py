@@ -0,0 +1,45 @@
+from pymongo import ASCENDING, ReplaceOne
+
+from metrics import measure
+
+#remove figure and table captions from the page text, they are kept on the figure/table itself
+def strip_captions(page_obj):
+    for figure in page_obj['figures']:
+        caption=figure['caption']
+        if caption in page_obj['text']:
+            page_obj['text']=page_obj['text'].replace(caption,'')
+    for table in page_obj['tables']:
+        caption = table['caption']
+        if caption in page_obj['text']:
+            page_obj['text']=page_obj['text'].replace(caption,'')
+    return page_obj
+
+def ensure_page_indexes(collection):
+    collection.create_index([("bookId", ASCENDING), ("page_num", ASCENDING)], unique=True)
+
+#page numbers of a book that are already stored
+def persisted_pages(collection, bookId):
+    return {doc["page_num"] for doc in collection.find({"bookId": bookId}, {"page_num": 1, "_id": 0})}
+
+# Buffers finished pages and writes them to the page collection with one bulk_write per batch.
+# Pages are upserted on (bookId, page_num) so re-writing a page after a resume is harmless.
+class PageWriter:
+    def __init__(self, collection, bookId, batch_size=20):
+        self.collection = collection
+        self.bookId = bookId
+        self.batch_size = batch_size
+        self.pending = []
+        self.written = 0
+
+    def add(self, page_obj):
+        page_doc = dict(strip_captions(page_obj), bookId=self.bookId)
+        self.pending.append(ReplaceOne({"bookId": self.bookId, "page_num": page_doc["page_num"]}, page_doc, upsert=True))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with measure("db_write"):
+                self.collection.bulk_write(self.pending, ordered=False)
+            self.written += len(self.pending)
+            self.pending = []
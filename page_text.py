@@ -0,0 +1,170 @@
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pytesseract
+from PIL import Image
+from metrics import measure, timed
+
+# MuPDF documents are not thread safe: renders and text extraction of pages go through this lock
+fitz_lock = threading.RLock()
+
+#clamp the rectangle to the page and return the crop as a view of the page array (no copy)
+def crop_region(image, x1, y1, x2, y2):
+    x1 = max(0, x1)
+    y1 = max(0, y1)
+    x2 = min(image.shape[1], x2)
+    y2 = min(image.shape[0], y2)
+    return image[int(y1):int(y2), int(x1):int(x2)]
+
+#crop a layout block expanded by `padding` pixels on every side
+def crop_block(image, layout_block, padding=5):
+    x1, y1, x2, y2 = layout_block.block.x_1, layout_block.block.y_1, layout_block.block.x_2, layout_block.block.y_2
+    return crop_region(image, x1 - padding, y1 - padding, x2 + padding, y2 + padding)
+
+#extraction of text from an in-memory crop using pytesseract
+@timed("ocr")
+def ocr_image(cropped_image):
+    return pytesseract.image_to_string(Image.fromarray(cropped_image))
+
+# Text of the layout blocks of one page, memoized by block rectangle so every handler on the page
+# (text/title/list and the figure caption search over neighbouring blocks) shares one result per block.
+# Subclasses extract the text of a block not seen yet
+class PageText(ABC):
+    def __init__(self, image):
+        self.image = image
+        self.texts = {}
+
+    def text(self, layout_block, padding=5):
+        block = layout_block.block
+        key = (block.x_1, block.y_1, block.x_2, block.y_2, padding)
+        if key not in self.texts:
+            self.texts[key] = self.extract(layout_block, padding)
+        return self.texts[key]
+
+    @abstractmethod
+    def extract(self, layout_block, padding):
+        pass
+
+# One tesseract run per block crop
+class BlockOCR(PageText):
+    source = "ocr"
+
+    def extract(self, layout_block, padding):
+        return ocr_image(crop_block(self.image, layout_block, padding))
+
+# Text sources holding the words of the whole page with their boxes: a word belongs to every block
+# whose padded rectangle contains its center, the same words a crop of that rectangle would show
+class PageWords(PageText):
+    def set_words(self, words, lines, center_x, center_y):
+        self.words = words
+        # words of one line share a key and are joined with spaces, lines with newlines
+        self.lines = lines
+        self.center_x = center_x
+        self.center_y = center_y
+
+    #indexes of the block's words, in reading order
+    def block_words(self, layout_block, padding):
+        x1, y1, x2, y2 = layout_block.block.x_1, layout_block.block.y_1, layout_block.block.x_2, layout_block.block.y_2
+        inside = ((self.center_x >= x1 - padding) & (self.center_x <= x2 + padding) &
+                  (self.center_y >= y1 - padding) & (self.center_y <= y2 + padding))
+        return np.flatnonzero(inside)
+
+    def join_words(self, indexes):
+        lines = []
+        previous_line = None
+        for index in indexes:
+            if self.lines[index] != previous_line:
+                lines.append([])
+                previous_line = self.lines[index]
+            lines[-1].append(self.words[index])
+        return "\n".join(" ".join(words) for words in lines) + "\n"
+
+# One tesseract run per page; the words are handed to the layout blocks by geometry. Tesseract runs
+# on the first block that is not already known, so a page whose texts all come from the result
+# cache is never recognized
+class PageWordOCR(PageWords):
+    source = "ocr"
+
+    def __init__(self, image):
+        super().__init__(image)
+        self.words = None
+
+    def recognize(self):
+        with measure("ocr"):
+            # a page rendered region by region (process_pdf.PageRegions) is rasterized whole here
+            data = pytesseract.image_to_data(Image.fromarray(np.asarray(self.image)), output_type=pytesseract.Output.DICT)
+        indexes = [i for i, word in enumerate(data["text"]) if word.strip()]
+        left = np.array([data["left"][i] for i in indexes], dtype=float)
+        top = np.array([data["top"][i] for i in indexes], dtype=float)
+        # tesseract's reading order groups words into block / paragraph / line
+        self.set_words([data["text"][i] for i in indexes],
+                       [(data["block_num"][i], data["par_num"][i], data["line_num"][i]) for i in indexes],
+                       left + np.array([data["width"][i] for i in indexes], dtype=float) / 2,
+                       top + np.array([data["height"][i] for i in indexes], dtype=float) / 2)
+
+    def extract(self, layout_block, padding):
+        if self.words is None:
+            self.recognize()
+        return self.join_words(self.block_words(layout_block, padding))
+
+#words of the PDF's own text layer as (x1, y1, x2, y2, word, block, line) in the pixels of a
+#render at `scale` pixels per point, plus the pixel rectangles of the page's embedded images
+def text_layer_words(page, scale):
+    import fitz
+    with fitz_lock:
+        matrix = page.rotation_matrix * fitz.Matrix(scale, scale)
+        page_words = page.get_text("words")
+        image_info = page.get_image_info()
+    words = []
+    for x1, y1, x2, y2, word, block_no, line_no, word_no in page_words:
+        rect = fitz.Rect(x1, y1, x2, y2) * matrix
+        words.append((rect.x0, rect.y0, rect.x1, rect.y1, word, block_no, line_no))
+    image_boxes = [tuple(fitz.Rect(info["bbox"]) * matrix) for info in image_info]
+    return words, image_boxes
+
+#whether a text layer can replace OCR: enough characters and hardly any unmapped glyphs
+#(U+FFFD, control characters) from fonts without a unicode table
+def text_layer_usable(words, min_chars=50, max_bad_ratio=0.05):
+    text = "".join(word[4] for word in words)
+    if len(text) < min_chars:
+        return False
+    bad = sum(char == "\ufffd" or (ord(char) < 32) for char in text)
+    return bad / len(text) <= max_bad_ratio
+
+# Text of the blocks taken from the PDF's text layer instead of OCR, handed to the blocks like
+# PageWordOCR's words. A block without any text-layer word that overlaps an embedded image (a
+# scanned region) is OCR'd from its crop instead.
+class PageTextLayer(PageWords):
+    source = "text_layer"
+
+    def __init__(self, image, words, image_boxes=()):
+        super().__init__(image)
+        boxes = np.array([word[:4] for word in words], dtype=float).reshape(-1, 4)
+        self.set_words([word[4] for word in words], [(word[5], word[6]) for word in words],
+                       (boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2)
+        self.image_boxes = list(image_boxes)
+        self.ocr_blocks = 0
+
+    def extract(self, layout_block, padding):
+        indexes = self.block_words(layout_block, padding)
+        if len(indexes):
+            return self.join_words(indexes)
+        x1, y1, x2, y2 = layout_block.block.x_1, layout_block.block.y_1, layout_block.block.x_2, layout_block.block.y_2
+        if any(bx1 < x2 and bx2 > x1 and by1 < y2 and by2 > y1 for bx1, by1, bx2, by2 in self.image_boxes):
+            self.ocr_blocks += 1
+            return ocr_image(crop_block(self.image, layout_block, padding))
+        return ""
+
+#text source for a page: the PDF text layer when `page` is given and its layer is usable, otherwise
+#tesseract, "block" per block crop or "page" once per page
+def page_ocr(image, mode="block", page=None, min_chars=50):
+    if page is not None:
+        with fitz_lock:
+            page_width = page.rect.width
+        words, image_boxes = text_layer_words(page, image.shape[1] / page_width)
+        if text_layer_usable(words, min_chars):
+            return PageTextLayer(image, words, image_boxes)
+    if mode == "page":
+        return PageWordOCR(image)
+    return BlockOCR(image)
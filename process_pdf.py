@@ -1,182 +1,939 @@
 from dotenv import load_dotenv
-import layoutparser as lp
-import pytesseract
 from PIL import Image
 import os
-import subprocess
-import img2pdf
-import fitz
-import shutil
+import io
+import math
 import traceback
-import boto3
+import copy
 import re
-import cv2
 import pymongo
 from urllib.parse import urlparse
 import urllib
 import time
 import uuid
-from PyPDF2 import PdfReader
+import numpy as np
 from multiprocessing import Pool
-from tablecaption import process_book_page
-from model_loader import ModelLoader 
+from functools import partial
+from collections import Counter
+from concurrent.futures import Future
+from threading import Event, Lock, RLock
+from tablecaption import process_book_page, get_table_ocr_client
+from result_cache import ResultCache, content_digest
+from speech_cache import EquationSpeechCache
+from page_store import PageWriter, ensure_page_indexes, persisted_pages
+from s3_uploader import FigureUploader
+from book_prefetcher import BookPrefetcher
+from work_queue import BookQueue, LeaseHeartbeat, new_worker_id
+from page_text import crop_block, crop_region, page_ocr, fitz_lock
+from page_filter import PageFilter
+from stage_pipeline import Stage, StagePipeline
+from memory_budget import MemoryBudget
 from utils import timeit
+import metrics
 from latext import latex_to_text
 load_dotenv()
 
-# Configure AWS credentials
-aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID']
-aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY']
-aws_region = os.environ['AWS_REGION']
+# the Mongo and S3 clients (and the models, see warm_up_models) are created on first use, so
+# importing this module connects to nothing and every forked process builds its own clients
+DATABASE_NAME = os.environ.get('DATABASE_NAME', 'aws_book_set_2')
+# load the models before page workers fork, so they share the weights and no page pays for loading
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', '1') == '1'
 
-client = pymongo.MongoClient(os.environ['DATABASE_URL'])
-db = client.aws_book_set_2
-bookdata = db.bookdata
-error_collection = db.error_collection
+_mongo_client = None
+_s3_client = None
+# the lazily built clients and caches below are first reached from several pipeline threads at once,
+# each must be built only once
+_singletons_lock = RLock()
 
+#database of this process; pymongo clients are not fork-safe, so a forked process opens its own
+def get_db():
+    global _mongo_client
+    with _singletons_lock:
+        if _mongo_client is None or _mongo_client[0] != os.getpid():
+            _mongo_client = (os.getpid(), pymongo.MongoClient(os.environ['DATABASE_URL']))
+        return _mongo_client[1][DATABASE_NAME]
 
-# Create an S3 client
-s3 = boto3.client('s3',
-                   aws_access_key_id=aws_access_key_id,
-                   aws_secret_access_key=aws_secret_access_key,
-                   region_name=aws_region)
+#S3 client of this process, boto3 clients must not be shared across a fork either
+def get_s3():
+    global _s3_client
+    with _singletons_lock:
+        if _s3_client is None or _s3_client[0] != os.getpid():
+            import boto3
+            client = boto3.client('s3',
+                                  aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                                  aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+                                  region_name=os.environ['AWS_REGION'])
+            _s3_client = (os.getpid(), client)
+        return _s3_client[1]
 
-bucket_name = os.environ['AWS_BUCKET_NAME']
+# page-level parallelism: PAGE_WORKERS=1 keeps the sequential loop, 0 uses every core
+PAGE_WORKERS = int(os.environ.get('PAGE_WORKERS', 1))
+PAGE_CHUNKSIZE = int(os.environ.get('PAGE_CHUNKSIZE', 1))
+# pages rendered and sent through the layout models together
+DETECT_BATCH_SIZE = int(os.environ.get('DETECT_BATCH_SIZE', 1))
+
+# pages per bulk_write into the page collection, and whether a re-run skips pages already stored
+PAGE_WRITE_BATCH = int(os.environ.get('PAGE_WRITE_BATCH', 20))
+PAGE_RESUME = os.environ.get('PAGE_RESUME', '1') == '1'
+
+# background figure uploads: concurrent uploads, how many encoded figures may wait in memory and
+# how many figure hashes are remembered to skip uploading a repeated figure
+FIGURE_UPLOAD_WORKERS = int(os.environ.get('FIGURE_UPLOAD_WORKERS', 4))
+FIGURE_UPLOAD_QUEUE = int(os.environ.get('FIGURE_UPLOAD_QUEUE', 32))
+FIGURE_UPLOAD_DIGESTS = int(os.environ.get('FIGURE_UPLOAD_DIGESTS', 10000))
+
+# bytes of upcoming books process_books may hold in memory while the current book is processed
+PREFETCH_BYTES = int(os.environ.get('PREFETCH_BYTES', 1024 ** 3))
+
+# corpus work queue: how long a claimed book stays leased without a heartbeat, and how often to beat
+QUEUE_LEASE_SECONDS = int(os.environ.get('QUEUE_LEASE_SECONDS', 600))
+QUEUE_HEARTBEAT_SECONDS = int(os.environ.get('QUEUE_HEARTBEAT_SECONDS', 60))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get('QUEUE_MAX_ATTEMPTS', 3))
+
+# render settings per stage: "detect" feeds layout detection, "layout" the block crops and OCR, which
+# render just their regions of the page, "nougat" feeds nougat. Detectron2 resizes the short side of
+# a page to DETECT_MIN_SIZE px (the models' INPUT.MIN_SIZE_TEST) before detecting, so each page is
+# rendered for detection at the dpi that gives its short side that many pixels: 100 dpi for a letter
+# page, 134 for a 6x9 in trim. The "detect" dpi is the floor, the "layout" dpi the ceiling.
+DETECT_MIN_SIZE = int(os.environ.get('DETECT_MIN_SIZE', 800))
+RENDER_SETTINGS = {
+    "detect": {"dpi": int(os.environ.get('DETECT_DPI', 100)), "colorspace": os.environ.get('LAYOUT_COLORSPACE', 'rgb')},
+    "layout": {"dpi": int(os.environ.get('LAYOUT_DPI', 300)), "colorspace": os.environ.get('LAYOUT_COLORSPACE', 'rgb')},
+    "nougat": {"dpi": int(os.environ.get('NOUGAT_DPI', 96)), "colorspace": os.environ.get('NOUGAT_COLORSPACE', 'rgb')},
+}
+COLORSPACES = {"rgb": "csRGB", "gray": "csGRAY"}
+
+# "cascade" runs TableBank only on pages where PubLayNet found a Table or a block scored below
+# TABLEBANK_CONFIDENCE, or whose ruling lines look like a table; "always" runs it on every page
+TABLEBANK_MODE = os.environ.get('TABLEBANK_MODE', 'cascade')
+TABLEBANK_CONFIDENCE = float(os.environ.get('TABLEBANK_CONFIDENCE', 0.9))
+
+# pages with less than PAGE_FILTER_MAX_INK of their pixels inked are stored empty; a page whose hash
+# is within PAGE_FILTER_MAX_DISTANCE (fraction of the bits) of an earlier page of the book handled by
+# the same process, and whose ink differs by at most PAGE_FILTER_MAX_INK_CHANGE, reuses its result
+PAGE_FILTER = os.environ.get('PAGE_FILTER', '1') == '1'
+PAGE_FILTER_MAX_INK = float(os.environ.get('PAGE_FILTER_MAX_INK', 0.0001))
+PAGE_FILTER_MAX_DISTANCE = float(os.environ.get('PAGE_FILTER_MAX_DISTANCE', 0.01))
+PAGE_FILTER_MAX_INK_CHANGE = float(os.environ.get('PAGE_FILTER_MAX_INK_CHANGE', 0.05))
+
+# "stream" runs a book's pages through a pipeline of stages on threads of their own, connected by
+# queues of PIPELINE_QUEUE_SIZE pages, so the CPU bound stages keep working while others wait on the
+# network; "batch" processes DETECT_BATCH_SIZE pages at a time, on PAGE_WORKERS processes
+PAGE_PIPELINE = os.environ.get('PAGE_PIPELINE', 'stream')
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 4))
+# threads per stream stage; renders share one lock as MuPDF is not thread safe
+STAGE_WORKERS = {
+    "render": int(os.environ.get('RENDER_WORKERS', 1)),
+    "detect": int(os.environ.get('DETECT_WORKERS', 1)),
+    "nougat": int(os.environ.get('NOUGAT_WORKERS', 1)),
+    "ocr": int(os.environ.get('OCR_WORKERS', 4)),
+    "external": int(os.environ.get('EXTERNAL_WORKERS', 8)),
+}
+# bytes of page images a book may have in flight at once, estimated from each page's size at the
+# render resolutions; a page (or batch) starts only once it fits, 0 means no limit
+MEMORY_BUDGET_BYTES = int(os.environ.get('MEMORY_BUDGET_BYTES', 2 * 1024 ** 3))
+
+# "page" runs the nougat engine on every batch of rendered pages, "book" runs it once over the original PDF
+NOUGAT_MODE = os.environ.get('NOUGAT_MODE', 'page')
+NOUGAT_MODEL = os.environ.get('NOUGAT_MODEL', '0.1.0-small')
+NOUGAT_BATCH_SIZE = int(os.environ.get('NOUGAT_BATCH_SIZE', 4))
+
+# "block" runs tesseract on every block crop, "page" runs it once per page and assigns the words to blocks
+OCR_MODE = os.environ.get('OCR_MODE', 'block')
+# "auto" takes the text of born-digital pages from the PDF's own text layer when it has at least
+# TEXT_LAYER_MIN_CHARS readable characters (OCR only for blocks over embedded images), "off" always OCRs
+TEXT_LAYER = os.environ.get('TEXT_LAYER', 'auto')
+TEXT_LAYER_MIN_CHARS = int(os.environ.get('TEXT_LAYER_MIN_CHARS', 50))
+
+# content-addressed cache of stage results, keyed by the rendered page pixels (or the table crop)
+# plus the stage version; bump a version, or run `python result_cache.py invalidate <stage>`,
+# when a model or its config changes. Disabled when RESULT_CACHE_DIR is empty.
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '')
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+CACHE_VERSIONS = {
+    "layout": f"publaynet-x101+tablebank-r50:1:{RENDER_SETTINGS['detect']}:{DETECT_MIN_SIZE}:{TABLEBANK_MODE}:{TABLEBANK_CONFIDENCE}",
+    "ocr": f"tesseract-{OCR_MODE}:1:{RENDER_SETTINGS['layout']}:{RENDER_SETTINGS['detect']}:{DETECT_MIN_SIZE}",
+    "table": "bud-ocr:1",
+    "nougat": f"{NOUGAT_MODEL}:1:{RENDER_SETTINGS['nougat']}",
+}
+# spoken text of equations: an in-process LRU of SPEECH_CACHE_ENTRIES in front of a store in
+# SPEECH_CACHE_DIR shared by every worker and run (in-process only when it is empty)
+SPEECH_CACHE_DIR = os.environ.get('SPEECH_CACHE_DIR', '.speech_cache')
+SPEECH_CACHE_ENTRIES = int(os.environ.get('SPEECH_CACHE_ENTRIES', 10000))
+SPEECH_CACHE_MAX_BYTES = int(os.environ.get('SPEECH_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+SPEECH_VERSIONS = {"speech": "latext:3"}
+
+_result_cache = None
+
+#the result cache, opened on first use; None when it is disabled
+def get_result_cache():
+    global _result_cache
+    with _singletons_lock:
+        if _result_cache is None and RESULT_CACHE_DIR:
+            _result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, CACHE_VERSIONS)
+            # entries written under older stage versions can never hit again
+            for stage in CACHE_VERSIONS:
+                _result_cache.invalidate(stage)
+        return _result_cache
+
+_speech_cache = None
+
+#equation speech cache, set up on first use
+def get_speech_cache():
+    global _speech_cache
+    with _singletons_lock:
+        if _speech_cache is None:
+            store = None
+            if SPEECH_CACHE_DIR:
+                store = ResultCache(SPEECH_CACHE_DIR, SPEECH_CACHE_MAX_BYTES, SPEECH_VERSIONS)
+                store.invalidate("speech")
+            _speech_cache = EquationSpeechCache(latext_to_text_to_speech, store, SPEECH_CACHE_ENTRIES)
+        return _speech_cache
 # folder_name = 'book-set-2'
 
+# returns every object key under the prefix, list_objects_v2 stops at 1000 keys per call
+def list_book_keys(bucket_name, folder_name):
+  paginator = get_s3().get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket_name, Prefix=folder_name):
+    for obj in page.get('Contents', []):
+      yield obj['Key']
+
 # returns list of booknames
 @timeit
 def get_all_books_names(bucket_name, folder_name):
-  contents = s3.list_objects_v2(Bucket=bucket_name, Prefix=folder_name)
-  pdf_file_names = [obj['Key'] for obj in contents.get('Contents', [])]
+  pdf_file_names = list_book_keys(bucket_name, folder_name)
   book_names = [file_name.split('/')[1] for file_name in pdf_file_names]
   return book_names
 
+# S3 console url of an object, the form process_book takes
+def book_url(bucket_name, file_key):
+    return f"https://s3.console.aws.amazon.com/s3/object/{bucket_name}?region={os.environ['AWS_REGION']}&prefix={urllib.parse.quote_plus(file_key, safe='/')}"
+
+def get_book_queue():
+    return BookQueue(get_db().book_jobs, get_db().queue_workers, QUEUE_LEASE_SECONDS, QUEUE_MAX_ATTEMPTS)
+
+#enqueue every pdf under the bucket prefix as a book job, returns how many were new
+@timeit
+def enqueue_corpus(bucket_name, folder_name):
+    book_queue = get_book_queue()
+    book_queue.ensure_indexes()
+    urls = (book_url(bucket_name, key) for key in list_book_keys(bucket_name, folder_name) if key.endswith('.pdf'))
+    added = book_queue.enqueue(urls)
+    print(f"Enqueued {added} new books, queue: {book_queue.stats()['depth']}")
+    return added
+
+#claim books from the queue until it is empty, run as many of these as there are machines/cores to spare
+def run_queue_worker(worker_id=None, poll_seconds=0):
+    book_queue = get_book_queue()
+    worker_id = worker_id or new_worker_id()
+    book_queue.register_worker(worker_id)
+    if PRELOAD_MODELS:
+        warm_up_models()
+    while True:
+        job = book_queue.claim(worker_id)
+        if job is None:
+            if not poll_seconds:
+                return
+            time.sleep(poll_seconds)
+            continue
+        start_time = time.perf_counter()
+        with LeaseHeartbeat(book_queue, job, worker_id, QUEUE_HEARTBEAT_SECONDS) as heartbeat:
+            try:
+                pages = process_book(job["url"])
+                error = None if pages is not None else "book failed, see error_collection"
+            except Exception as e:
+                pages, error = None, e
+        busy_seconds = time.perf_counter() - start_time
+        if heartbeat.lost:
+            print(f"Lease on {job['url']} was lost, another worker owns it now")
+        elif error is None:
+            book_queue.complete(job, worker_id, pages)
+        else:
+            book_queue.fail(job, worker_id, error)
+        book_queue.record_progress(worker_id, 1 if error is None else 0, pages or 0, busy_seconds)
+        metrics.flush()
+
+# returns bucket name, object key, local folder and bookname of an S3 console url
+def parse_book_url(url):
+    parsed_url = urlparse(url)
+    bucket_name = parsed_url.path.split('/')[-1]
+    file_key_list = list(filter(lambda x: x.startswith('prefix='), parsed_url.query.split('&')))
+    file_key = file_key_list[0].split('=')[1]
+    file_key=urllib.parse.unquote_plus(file_key)
+    folder_name = file_key_list[0].split('/')[0]
+    folder_name = folder_name.replace('prefix=', '') 
+    bookname = file_key.split('/')[-1]
+    return bucket_name, file_key, folder_name, bookname
+
 # downlads particular book from aws and save it to system and return the bookpath
 @timeit
 def download_book_from_aws(url,bookId):
+    bookname = None
     try:
-        parsed_url = urlparse(url)
-        bucket_name = parsed_url.path.split('/')[-1]
-        file_key_list = list(filter(lambda x: x.startswith('prefix='), parsed_url.query.split('&')))
-        file_key = file_key_list[0].split('=')[1]
-        file_key=urllib.parse.unquote_plus(file_key)
-        folder_name = file_key_list[0].split('/')[0]
-        folder_name = folder_name.replace('prefix=', '') 
-        bookname = file_key.split('/')[-1]
+        bucket_name, file_key, folder_name, bookname = parse_book_url(url)
         os.makedirs(folder_name, exist_ok=True)
         local_path = os.path.join(folder_name, os.path.basename(file_key))
-        s3.download_file(bucket_name, file_key, local_path)
+        get_s3().download_file(bucket_name, file_key, local_path)
         return local_path,bookname 
     except Exception as e:
         print("An error occurred:", e)
-        data = {"bookId":{bookId},"book":{bookname}, "error":str(e), "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
-        error_collection.insert_one(data)
+        data = {"bookId":bookId,"book":bookname, "error":str(e), "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
+        get_db().error_collection.insert_one(data)
         return None
 
+#process books one after another while the next ones download in the background
+def process_books(urls, prefetch_bytes=PREFETCH_BYTES):
+    # the run report covers this run only, snapshots left by earlier ones are dropped
+    if metrics.METRICS_ENABLED:
+        metrics.clear()
+    if PRELOAD_MODELS:
+        warm_up_models()
+    run_tablebank = tablebank_snapshot()
+    prefetcher = BookPrefetcher(get_s3(), urls, lambda url: parse_book_url(url)[:2], max_bytes=prefetch_bytes)
+    for url, pdf_bytes, error in prefetcher:
+        if error is not None:
+            print(f"An error occurred while downloading {url}: {str(error)}")
+            get_db().error_collection.insert_one({"url": url, "error": str(error)})
+            continue
+        process_book(url, pdf_bytes=pdf_bytes)
+    # pool workers hand their counts back with their batches, so this covers every process
+    print("TableBank cascade over the run:", tablebank_summary(tablebank_since(run_tablebank)))
+    if metrics.METRICS_ENABLED:
+        metrics.write_report()
+
+# processes a book and returns the number of pages stored (None when it failed); with pdf_bytes
+# (already downloaded by process_books) it is opened straight from memory, otherwise it is
+# downloaded to disk first
 @timeit
-def process_book(url):
+def process_book(url, workers=PAGE_WORKERS, chunksize=PAGE_CHUNKSIZE, batch_size=DETECT_BATCH_SIZE, resume=PAGE_RESUME, pdf_bytes=None):
     bookId=uuid.uuid4().hex
-    book_path,bookname = download_book_from_aws(url, bookId)
-    book_folder = book_path.split('/')[-1].replace('.pdf','')
-    if not book_path:
-         return 
-    os.makedirs(book_folder, exist_ok=True)
-    book = PdfReader(book_path)  # Use book_path instead of bookname
-    print(bookname)
-    num_pages = len(book.pages)
-    print(f"{bookname} has total {num_pages} page")
+    pages_written = None
+    book_tablebank = tablebank_snapshot()
+    if pdf_bytes is None:
+        downloaded = download_book_from_aws(url, bookId)
+        if not downloaded:
+             return 
+        book_path,bookname = downloaded
+    else:
+        # the in-memory book is kept under its key, nothing is written to disk
+        book_path = bookname = parse_book_url(url)[3]
     num_cpu_cores = os.cpu_count()
+    workers = workers or num_cpu_cores
+    bookdata, bookpages = get_db().bookdata, get_db().bookpages
     try:
-        page_data=[]
-        for page_num in range(num_pages):
-            page_object=process_page(page_num, book_path, book_folder, bookname,bookId)
-            page_data.append(page_object)
-
-        bookdata_doc = {
-            "bookId":bookId,
-            "book": bookname,
-            "pages": page_data
-        }
-        bookdata.insert_one(bookdata_doc)
+        # a corrupt or non-PDF object is recorded like any other failed book, the run goes on
+        book = open_document(book_path, pdf_bytes)
+        print(bookname)
+        num_pages = len(book)
+        print(f"{bookname} has total {num_pages} page")
+        ensure_page_indexes(bookpages)
+        # resuming picks the earlier unfinished run of the same S3 object back up (its bookId) and skips
+        # the pages it already stored; a book that completed is processed again under a new bookId
+        source = "/".join(parse_book_url(url)[:2])
+        existing = bookdata.find_one({"source": source, "status": {"$ne": "complete"}}, sort=[("_id", pymongo.DESCENDING)]) if resume else None
+        if existing:
+            bookId = existing["bookId"]
+        done_pages = persisted_pages(bookpages, bookId) if existing else set()
+        pending_pages = [page_num for page_num in range(num_pages) if page_num not in done_pages]
+        budget = MemoryBudget(MEMORY_BUDGET_BYTES)
+        working_sets = {page_num: page_working_set(book[page_num]) for page_num in pending_pages}
+        if done_pages:
+            print(f"Resuming {bookname}: {len(done_pages)} pages already stored, {len(pending_pages)} left")
+        bookdata.update_one({"bookId": bookId},
+                            {"$set": {"book": bookname, "source": source, "num_pages": num_pages, "status": "processing"}}, upsert=True)
+
+        batches = [pending_pages[start:start + batch_size] for start in range(0, len(pending_pages), batch_size)]
+        # whole-book nougat pass, pages fall back to the per-batch engine when it fails
+        book_latex = get_book_latext_text(pdf_bytes or book_path, num_pages, bookname, bookId) if NOUGAT_MODE == "book" and batches else None
+        batch_latex = [[book_latex[page_num] for page_num in batch] if book_latex else None for batch in batches]
+        # pages are written as they come back, in page order, a crash only loses the unwritten batch
+        page_writer = PageWriter(bookpages, bookId, PAGE_WRITE_BATCH)
+        text_sources = Counter()
+        if PAGE_PIPELINE == "stream":
+            pipeline = page_pipeline(page_writer)
+            jobs = admitted_page_jobs(pipeline, budget, working_sets, book_path, pending_pages, bookname, bookId, book_latex)
+            for page_obj in pipeline.run(jobs):
+                text_sources[page_obj.get("text_source")] += 1
+            # utilization and queue depth per stage, the bottleneck is the busiest stage with a full queue in front
+            print(f"{bookname} pipeline stages:", pipeline.stats())
+        elif workers > 1 and len(batches) > 1:
+            if PRELOAD_MODELS:
+                warm_up_models()
+            # workers open their own handle, never share the parent's file descriptor
+            close_document(book_path)
+            batch_args = [(book_path, batch, bookname, bookId, latex) for batch, latex in zip(batches, batch_latex)]
+            batch_sizes = [sum(working_sets[page_num] for page_num in batch) for batch in batches]
+            # imap hands batches out in chunks and yields the results back in page order; the pool's
+            # task thread takes a batch only once it fits the budget, and a batch held back in a
+            # half-filled chunk could wait on itself, so a limited budget hands them out one by one
+            stopped = Event()
+            with Pool(processes=min(workers, len(batches)), initializer=init_page_worker, initargs=(book_path, pdf_bytes)) as pool:
+                try:
+                    admitted = budget.admit(batch_args, batch_sizes, stopped.is_set)
+                    for (batch_data, tablebank), size in zip(pool.imap(process_page_task, admitted, chunksize=1 if budget.max_bytes else chunksize), batch_sizes):
+                        add_tablebank(tablebank)
+                        for page_obj in batch_data:
+                            text_sources[page_obj.get("text_source")] += 1
+                            page_writer.add(page_obj)
+                        budget.release(size)
+                finally:
+                    stopped.set()
+        else:
+            for batch, latex in zip(batches, batch_latex):
+                size = sum(working_sets[page_num] for page_num in batch)
+                budget.reserve(size)
+                for page_obj in process_page_batch(book_path, batch, bookname, bookId, latex):
+                    text_sources[page_obj.get("text_source")] += 1
+                    page_writer.add(page_obj)
+                budget.release(size)
+        page_writer.flush()
+
+        bookdata.update_one({"bookId": bookId}, {"$set": {"status": "complete"}})
+        print(f"{bookname}: stored {page_writer.written} pages")
+        # blank and duplicate pages are the ones the page filter kept from the models
+        print(f"{bookname} text sources:", dict(text_sources))
+        print(f"{bookname} memory budget:", budget.stats())
+        pages_written = page_writer.written
     except Exception as e:
-        data = {"bookId":{bookId},"book":{bookname},"error":str(e), "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
-        error_collection.insert_one(data)
-    #find document by name replace figure caption with ""
-    document = bookdata.find_one({"bookId":bookId})
-    if document:
-        for page in document['pages']:
-            for figure in page['figures']:
-                caption=figure['caption']
-                if caption in page['text']:
-                    page['text']=page['text'].replace(caption,'')
-            for table in page['tables']:
-                caption = table['caption']
-                if caption in page['text']:
-                    page['text']=page['text'].replace(caption,'')
+        data = {"bookId":bookId,"book":bookname,"error":str(e), "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
+        get_db().error_collection.insert_one(data)
+    if get_result_cache() is not None:
+        print("Result cache:", get_result_cache().stats())
+    print("Equation speech cache:", get_speech_cache().stats())
+    book_tablebank = tablebank_since(book_tablebank)
+    if book_tablebank["pages"]:
+        print(f"{bookname} TableBank cascade:", tablebank_summary(book_tablebank))
+    #delete the book
+    close_document(book_path)
+    if pdf_bytes is None:
+        os.remove(book_path)
+    return pages_written
 
+#load the models of the pipeline into this process. Called in the parent before page workers
+#fork, the workers inherit the loaded weights and share them copy-on-write; already loaded models
+#are left alone, so a worker forked from a warm parent does nothing here
+def warm_up_models():
+    from model_loader import ModelLoader
+    ModelLoader.warm_up(("PubLayNet", "TableBank"))
+    if NOUGAT_MODE == "page":
+        from nougat_engine import NougatEngine
+        NougatEngine(NOUGAT_MODEL, NOUGAT_BATCH_SIZE)
+
+#load the layout models once when a pool worker starts so no page pays for it
+def init_page_worker(book_path=None, pdf_bytes=None):
+    _open_documents.clear()
+    _page_filters.clear()
+    # an in-memory book reaches forked workers through the initializer arguments, not a temp file
+    if pdf_bytes is not None:
+        open_document(book_path, pdf_bytes)
+    warm_up_models()
+
+#pool entry point, unpacks the batch arguments; returns the page objects with the TableBank counts of
+#the batch, which the parent adds to its own
+def process_page_task(args):
+    before = tablebank_snapshot()
+    page_data = process_page_batch(*args)
+    return page_data, tablebank_since(before)
+
+#render a batch of pages, detect their layouts together and return their page objects in page order
+@timeit
+def process_page_batch(book_path, page_numbers, bookname, bookId, latex_texts=None):
+    with metrics.tagged(book=bookname):
+        page_data = process_tagged_page_batch(book_path, page_numbers, bookname, bookId, latex_texts)
+    # pool workers hand their stage metrics to the run report through their snapshot
+    metrics.flush()
+    return page_data
+
+def process_tagged_page_batch(book_path, page_numbers, bookname, bookId, latex_texts):
+    # detection sees a low resolution render, the block handlers crop from the layout resolution
+    pages = list(iter_page_images(open_document(book_path), page_numbers))
+    # blank pages and repeats of earlier pages skip the models
+    page_filter = get_page_filter(book_path)
+    verdicts = [page_filter.classify(image, page.number) if page_filter is not None else (None, None) for page, image in pages]
+    work = [index for index, (kind, original) in enumerate(verdicts) if kind is None]
+    processed = process_rendered_pages([pages[index] for index in work], bookname, bookId,
+                                       [latex_texts[index] for index in work] if latex_texts is not None else None)
+
+    page_data = [None] * len(pages)
+    for index, page_obj in zip(work, processed):
+        page_data[index] = page_obj
+        if page_filter is not None:
+            page_filter.remember(page_obj["page_num"], page_obj)
+    for index, (kind, original) in enumerate(verdicts):
+        if kind is not None:
+            page_data[index] = filtered_page_obj(pages[index][0], kind, page_filter.results.get(original))
+    # a page is only handed back (and stored) once its figures are in S3
+    get_figure_uploader().flush()
+    return page_data
+
+#detect the layouts of rendered pages together and return their page objects
+def process_rendered_pages(pages, bookname, bookId, latex_texts):
+    digests = [content_digest(image) if get_result_cache() is not None else None for page, image in pages]
+    layouts = page_layouts([image for page, image in pages], digests, bookname)
+    if latex_texts is None:
+        latex_texts = page_latex_texts(pages, digests, bookname, bookId)
+    return [process_page(page, page_regions(page, image), scale_layout(layout, detect_scale(page)), latex_text, bookname, bookId, digest)
+            for (page, image), layout, latex_text, digest in zip(pages, layouts, latex_texts, digests)]
+
+#layouts of rendered pages from the result cache, the others detected together; a page is left None
+#when the batched detection fails, it retries on its own and reports its own error
+def page_layouts(images, digests, bookname):
+    layouts = [cache_get("layout", digest) for digest in digests]
+    layouts = [records_to_layout(records) if records is not None else None for records in layouts]
+    missing = [index for index, layout in enumerate(layouts) if layout is None]
+    if missing:
         try:
-            result = bookdata.update_one({'_id': document['_id']}, {'$set': {'pages': document['pages']}})
-            if result.modified_count == 1:
-                print("Document updated successfully.")
-            else:
-                print("Document update did not modify any document.")
+            detected = detect_layouts([images[index] for index in missing])
+            for index, layout in zip(missing, detected):
+                layouts[index] = layout
+                cache_put("layout", digests[index], layout_to_records(layout))
         except Exception as e:
-            print("An error occurred:", str(e))
-    #delete the book
-    os.remove(book_path)
-    shutil.rmtree(book_folder)
+            print(f"Batched layout detection failed for {bookname}: {str(e)}")
+    return layouts
+
+#nougat text of rendered pages from the result cache, the others predicted together
+def page_latex_texts(pages, digests, bookname, bookId):
+    latex_texts = [cache_get("nougat", digest) for digest in digests]
+    missing = [index for index, latex_text in enumerate(latex_texts) if latex_text is None]
+    if missing:
+        nougat_images = [nougat_stage_image(*pages[index]) for index in missing]
+        predicted = get_latext_text(nougat_images, [pages[index][0].number for index in missing], bookname, bookId)
+        for index, latex_text in zip(missing, predicted):
+            if latex_text is not None:
+                cache_put("nougat", digests[index], latex_text)
+            latex_texts[index] = latex_text or ""
+    return latex_texts
+
+#page object of a page the filter kept from the models: empty for a blank page, a copy of the
+#repeated page's content for a duplicate
+def filtered_page_obj(page, kind, original=None):
+    page_obj = {"id": uuid.uuid4().hex, "page_num": page.number, "text": "", "tables": [], "figures": [], "equations": [], "text_source": kind}
+    if original is not None:
+        page_obj.update(copy.deepcopy({key: original[key] for key in ("text", "tables", "figures", "equations", "nougat_extraction") if key in original}))
+        page_obj["duplicate_of"] = original["page_num"]
+    record_text_source(None, kind)
+    return page_obj
+
+# A page on its way through the stream pipeline, each stage fills in its part
+class PageJob:
+    def __init__(self, book_path, page_num, bookname, bookId, latex_text=None):
+        self.book_path = book_path
+        self.page_num = page_num
+        self.bookname = bookname
+        self.bookId = bookId
+        self.page = None
+        self.image = None
+        # (kind, page it repeats) from the page filter, kind None for a page the models look at
+        self.verdict = (None, None)
+        self.digest = None
+        self.layout = None
+        self.latex_text = latex_text
+        # table OCR responses the page text waits for, resolved by the external stage
+        self.pending_tables = []
+        self.page_obj = None
+        # estimated bytes of the page's images, held in the budget until the OCR stage lets them go
+        self.budget = None
+        self.working_set = 0
+
+#the book's pages as pipeline jobs, each one let in once its working set fits the budget
+def admitted_page_jobs(pipeline, budget, working_sets, book_path, pending_pages, bookname, bookId, book_latex):
+    for page_num in pending_pages:
+        job = PageJob(book_path, page_num, bookname, bookId, book_latex[page_num] if book_latex else None)
+        job.budget, job.working_set = budget, working_sets[page_num]
+        if not budget.reserve(job.working_set, pipeline.stopped.is_set):
+            return
+        yield job
+
+#stages of a book's stream pipeline: render -> filter -> detect -> nougat -> region OCR -> external
+#calls (table OCR, figure uploads) -> assemble -> persist, with the page objects coming out in page order
+def page_pipeline(page_writer):
+    return StagePipeline([
+        Stage("render", render_stage, STAGE_WORKERS["render"]),
+        Stage("filter", filter_stage, ordered=True),
+        Stage("detect", detect_stage, STAGE_WORKERS["detect"], batch_size=DETECT_BATCH_SIZE),
+        Stage("nougat", nougat_stage, STAGE_WORKERS["nougat"], batch_size=NOUGAT_BATCH_SIZE),
+        Stage("ocr", ocr_stage, STAGE_WORKERS["ocr"]),
+        Stage("external", external_stage, STAGE_WORKERS["external"]),
+        Stage("assemble", assemble_stage, ordered=True),
+        Stage("persist", partial(persist_stage, page_writer), ordered=True),
+    ], PIPELINE_QUEUE_SIZE)
+
+def render_stage(job):
+    with metrics.tagged(book=job.bookname, page=job.page_num):
+        with fitz_lock:
+            job.page = open_document(job.book_path)[job.page_num]
+        job.image = render_page(job.page, **detect_settings(job.page))
+    return job
+
+#pages are filtered in page order, a repeat always refers to an earlier page
+def filter_stage(job):
+    page_filter = get_page_filter(job.book_path)
+    if page_filter is not None:
+        job.verdict = page_filter.classify(job.image, job.page_num)
+    if job.verdict[0] is not None:
+        job.image = None
+    return job
+
+def detect_stage(jobs):
+    work = [job for job in jobs if job.image is not None]
+    if work:
+        with metrics.tagged(book=work[0].bookname):
+            for job in work:
+                job.digest = content_digest(job.image) if get_result_cache() is not None else None
+            for job, layout in zip(work, page_layouts([job.image for job in work], [job.digest for job in work], work[0].bookname)):
+                job.layout = layout
+    return jobs
+
+def nougat_stage(jobs):
+    work = [job for job in jobs if job.image is not None and job.latex_text is None]
+    if work:
+        with metrics.tagged(book=work[0].bookname):
+            latex_texts = page_latex_texts([(job.page, job.image) for job in work], [job.digest for job in work], work[0].bookname, work[0].bookId)
+        for job, latex_text in zip(work, latex_texts):
+            job.latex_text = latex_text
+    return jobs
+
+#the page's text and figures; its table crops are sent off and resolved by the external stage
+def ocr_stage(job):
+    if job.image is not None:
+        with metrics.tagged(book=job.bookname):
+            job.page_obj = process_page(job.page, page_regions(job.page, job.image), scale_layout(job.layout, detect_scale(job.page)),
+                                        job.latex_text, job.bookname, job.bookId, job.digest, job.pending_tables)
+        job.image = None
+    if job.budget is not None:
+        job.budget.release(job.working_set)
+    return job
+
+#wait for the page's table OCR responses and figure uploads
+def external_stage(job):
+    if job.page_obj is None:
+        return job
+    with metrics.tagged(book=job.bookname, page=job.page_num):
+        try:
+            text = resolve_pending_tables(job.page_obj["text"], job.pending_tables, job.page_obj["tables"])
+            job.page_obj["text"] = re.sub(r'\s+', ' ', text).strip()
+        except Exception as e:
+            print(f"An error occurred while processing {job.bookname}, page {job.page_num}: {str(e)}")
+            record_page_error(job.bookId, job.bookname, job.page_num, e)
+            job.page_obj.update(text="", tables=[], figures=[], equations=[])
+        # a page is only stored once its figures are in S3
+        get_figure_uploader().wait([figure["url"] for figure in job.page_obj["figures"]])
+    return job
+
+#page objects of the filtered pages; runs in page order, so the page a duplicate repeats is done
+def assemble_stage(job):
+    page_filter = get_page_filter(job.book_path)
+    kind, original = job.verdict
+    if kind is not None:
+        job.page_obj = filtered_page_obj(job.page, kind, page_filter.results.get(original))
+    elif page_filter is not None:
+        page_filter.remember(job.page_num, job.page_obj)
+    return job
+
+def persist_stage(page_writer, job):
+    page_writer.add(job.page_obj)
+    return job.page_obj
+
+#the page as the nougat stage wants it, reusing the detection render when the settings match
+def nougat_stage_image(page, image):
+    if RENDER_SETTINGS["nougat"] == detect_settings(page):
+        return image
+    return render_page(page, **RENDER_SETTINGS["nougat"])
+
+#the page at the layout resolution for the block handlers: the detection render itself when the
+#settings match, otherwise a PageRegions rendering only the regions they crop
+def page_regions(page, image):
+    if RENDER_SETTINGS["layout"] == detect_settings(page):
+        return image
+    return PageRegions(page, **RENDER_SETTINGS["layout"])
+
+#bytes of the page rendered with `settings`
+def render_bytes(page, settings):
+    with fitz_lock:
+        width, height = page.rect.width, page.rect.height
+    scale = settings["dpi"] / 72
+    return int(width * scale) * int(height * scale) * (3 if settings["colorspace"] == "rgb" else 1)
+
+#estimated peak bytes of a page's images: the detection render, a layout resolution region (up to
+#the whole page for page OCR) with its encoded copy, and the nougat render when it is a separate one
+def page_working_set(page):
+    size = render_bytes(page, detect_settings(page)) + 2 * render_bytes(page, RENDER_SETTINGS["layout"])
+    if RENDER_SETTINGS["nougat"] != detect_settings(page):
+        size += render_bytes(page, RENDER_SETTINGS["nougat"])
+    return size
+
+#render settings of the page for layout detection: the dpi at which its short side has
+#DETECT_MIN_SIZE pixels, within the "detect" and "layout" dpi
+def detect_settings(page):
+    settings = RENDER_SETTINGS["detect"]
+    with fitz_lock:
+        short_side = min(page.rect.width, page.rect.height)
+    if short_side <= 0:
+        return settings
+    dpi = min(math.ceil(DETECT_MIN_SIZE * 72 / short_side), RENDER_SETTINGS["layout"]["dpi"])
+    return dict(settings, dpi=max(settings["dpi"], dpi))
+
+#pixels of the layout resolution per pixel of the page's detection render
+def detect_scale(page):
+    return RENDER_SETTINGS["layout"]["dpi"] / detect_settings(page)["dpi"]
 
-#convert pages into images and return all pages data
+#layout blocks with their rectangles scaled by `factor`, None stays None
+def scale_layout(layout, factor):
+    if layout is None or factor == 1:
+        return layout
+    return records_to_layout([(block_type, x_1 * factor, y_1 * factor, x_2 * factor, y_2 * factor, score)
+                              for block_type, x_1, y_1, x_2, y_2, score in layout_to_records(layout)])
+
+#look a stage result up in the result cache, None when the cache is off or misses
+def cache_get(stage, digest):
+    if get_result_cache() is None or digest is None:
+        return None
+    return get_result_cache().get(stage, digest)
+
+def cache_put(stage, digest, value):
+    if get_result_cache() is not None and digest is not None:
+        get_result_cache().put(stage, digest, value)
+
+#layout blocks as plain records for the result cache, and back
+def layout_to_records(layout):
+    return [(block.type, block.block.x_1, block.block.y_1, block.block.x_2, block.block.y_2, block.score) for block in layout]
+
+def records_to_layout(records):
+    import layoutparser as lp
+    return [lp.TextBlock(lp.Rectangle(x_1, y_1, x_2, y_2), type=block_type, score=score)
+            for block_type, x_1, y_1, x_2, y_2, score in records]
+
+_page_filters = {}
+
+#blank and duplicate page filter of a book in this process, None when PAGE_FILTER is off
+def get_page_filter(book_path):
+    if not PAGE_FILTER:
+        return None
+    page_filter = _page_filters.get(book_path)
+    if page_filter is None:
+        page_filter = _page_filters[book_path] = PageFilter(PAGE_FILTER_MAX_INK, PAGE_FILTER_MAX_DISTANCE, PAGE_FILTER_MAX_INK_CHANGE)
+    return page_filter
+
+_open_documents = {}
+
+#one lazily opened document handle per book and process, opened from pdf_bytes when given
+def open_document(book_path, pdf_bytes=None):
+    document = _open_documents.get(book_path)
+    if document is None:
+        import fitz
+        if pdf_bytes is not None:
+            document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        else:
+            document = fitz.open(book_path)
+        _open_documents[book_path] = document
+    return document
+
+def close_document(book_path):
+    _page_filters.pop(book_path, None)
+    document = _open_documents.pop(book_path, None)
+    if document is not None:
+        document.close()
+
+# keeps the pixmap alive for as long as a numpy array is viewing its samples
+class PixmapBuffer:
+    def __init__(self, pixmap):
+        self.pixmap = pixmap
+        self.__array_interface__ = {
+            "shape": (pixmap.height, pixmap.width, pixmap.n),
+            "typestr": "|u1",
+            "strides": (pixmap.stride, pixmap.n, 1),
+            # a raw pointer makes numpy hold this object (and so the pixmap) as the array base;
+            # with a buffer it would only hold the memoryview, which does not keep the pixmap alive
+            "data": (pixmap.samples_ptr, False),
+            "version": 3,
+        }
+
+#render a page and expose the pixmap sample buffer as a numpy array without copying it
+@timeit("render")
+def render_page(page, dpi=300, colorspace="rgb"):
+    import fitz
+    with fitz_lock:
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), colorspace=getattr(fitz, COLORSPACES[colorspace]), alpha=False)
+    image = np.asarray(PixmapBuffer(pixmap))
+    return image if pixmap.n > 1 else image[..., 0]
+
+#render the pixels x1:x2, y1:y2 of the page rendered at `dpi` without rasterizing the rest of it
+@timeit("render")
+def render_region(page, x1, y1, x2, y2, dpi=300, colorspace="rgb"):
+    import fitz
+    scale = dpi / 72
+    channels = 3 if colorspace == "rgb" else 1
+    if x2 <= x1 or y2 <= y1:
+        image = np.zeros((max(y2 - y1, 0), max(x2 - x1, 0), channels), dtype=np.uint8)
+    else:
+        # the clip is in the coordinates of the rotated page, like the pixels of a full render
+        with fitz_lock:
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=fitz.Rect(x1 / scale, y1 / scale, x2 / scale, y2 / scale),
+                                     colorspace=getattr(fitz, COLORSPACES[colorspace]), alpha=False)
+        image = np.asarray(PixmapBuffer(pixmap))[:y2 - y1, :x2 - x1]
+    return image if channels > 1 else image[..., 0]
+
+# A page at `dpi` that is only rasterized where it is looked at: slicing it like the page array
+# (image[y1:y2, x1:x2], as crop_region does) renders just that region, np.asarray() renders the
+# whole page once for the handlers that need all of it (page mode OCR)
+class PageRegions:
+    def __init__(self, page, dpi=300, colorspace="rgb"):
+        import fitz
+        self.page = page
+        self.dpi = dpi
+        self.colorspace = colorspace
+        with fitz_lock:
+            bounds = (page.rect * fitz.Matrix(dpi / 72, dpi / 72)).irect
+        self.shape = (bounds.height, bounds.width, 3) if colorspace == "rgb" else (bounds.height, bounds.width)
+        self.ndim = len(self.shape)
+        self.image = None
+
+    def __getitem__(self, key):
+        if self.image is not None:
+            return self.image[key]
+        rows, columns = key
+        return render_region(self.page, columns.start, rows.start, columns.stop, rows.stop, self.dpi, self.colorspace)
+
+    def __array__(self, dtype=None, copy=None):
+        if self.image is None:
+            self.image = render_page(self.page, self.dpi, self.colorspace)
+        return self.image if dtype is None else self.image.astype(dtype)
+
+#lazily render pages of an open document for layout detection, only the current page is held in memory
+def iter_page_images(document, page_numbers=None):
+    if page_numbers is None:
+        page_numbers = range(len(document))
+    for page_num in page_numbers:
+        with fitz_lock:
+            page = document[page_num]
+        yield page, render_page(page, **detect_settings(page))
+
+#extract the data of a rendered page and return the page object
 @timeit
-def process_page(page_num, book_path, book_folder, bookname, bookId):
-    pages_data=[]
-    pdf_images = fitz.open(book_path)
-    page_image = pdf_images[page_num]
-    book_image = page_image.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
-    image_path = os.path.join(book_folder, f'page_{page_num + 1}.jpg')
-    book_image.save(image_path)
-    page_content,page_tables,page_figures, page_equations, *nougat_extraction= process_image(image_path, page_num, bookname, bookId)
+def process_page(page, image, final_layout, latex_text, bookname, bookId, digest=None, pending_tables=None):
+    # which path produced the page text: "text_layer", "ocr" or "nougat"
+    page_report = {}
+    with metrics.tagged(page=page.number):
+        page_content,page_tables,page_figures, page_equations, *nougat_extraction= process_image(page, image, final_layout, latex_text, bookname, bookId, digest, page_report, pending_tables)
     pageId= uuid.uuid4().hex
     page_obj={
         "id":pageId,
+        "page_num":page.number,
         "text":page_content,
         "tables":page_tables,
         "figures":page_figures,
-        "equations":page_equations
+        "equations":page_equations,
+        "text_source":page_report.get("text_source")
     }
+    if page_report.get("ocr_blocks"):
+        page_obj["ocr_blocks"] = page_report["ocr_blocks"]
     if nougat_extraction:
         page_obj["nougat_extraction"] = nougat_extraction[0]
 
-    os.remove(image_path)
     return page_obj
 
-#detect layout and return page data
-@timeit
-def process_image(imagepath, page_num, bookname, bookId):
-    try:
-        image = cv2.imread(imagepath)
-        image = image[..., ::-1]
+#detect the layouts of a batch of page images with one forward pass per model
+@timeit("detect")
+def detect_layouts(images):
+    from model_loader import ModelLoader
+    layout_images = [image if image.ndim == 3 else np.stack([image] * 3, axis=-1) for image in images]
+
+    publaynet_layouts = ModelLoader("PubLayNet").detect_batch(layout_images)
+    tablebank_layouts = [[] for _ in images]
+    table_pages = [index for index, (image, layout) in enumerate(zip(images, publaynet_layouts)) if needs_tablebank(image, layout)]
+    if table_pages:
+        start_time = time.perf_counter()
+        detected = ModelLoader("TableBank").detect_batch([layout_images[index] for index in table_pages])
+        record_tablebank(len(images), len(table_pages), time.perf_counter() - start_time)
+        for index, layout in zip(table_pages, detected):
+            tablebank_layouts[index] = layout
+    else:
+        record_tablebank(len(images), 0, 0.0)
 
-        publaynet = ModelLoader("PubLayNet")
-        tablebank = ModelLoader("TableBank")
+    final_layouts = []
+    for publaynet_layout, tablebank_layout in zip(publaynet_layouts, tablebank_layouts):
+        final_layout = [block for block in publaynet_layout if block.type != "Table"]
+        # Add "Table" blocks from TableBank in place of PubLayNet's
+        final_layout += [block for block in tablebank_layout if block.type == "Table"]
+        final_layouts.append(final_layout)
+    return final_layouts
 
-        publaynet_model = publaynet.model
-        tablebank_model = tablebank.model
+#whether TableBank has to look at a page PubLayNet already detected
+def needs_tablebank(image, publaynet_layout):
+    if TABLEBANK_MODE == "always":
+        return True
+    if any(block.type == "Table" or (block.score is not None and block.score < TABLEBANK_CONFIDENCE) for block in publaynet_layout):
+        return True
+    return looks_like_table(image)
 
-        publaynet_layout = publaynet_model.detect(image)
-        tablebank_layout = tablebank_model.detect(image)
+#number of separate rows (axis 1: columns) holding a dark run of at least min_length pixels
+def count_rule_lines(dark, min_length):
+    padded = np.pad(dark, ((0, 0), (1, 1))).astype(np.int8)
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    longest = np.zeros(dark.shape[0], dtype=int)
+    np.maximum.at(longest, rows, ends - starts)
+    ruled = longest >= min_length
+    return int(np.count_nonzero(ruled[1:] & ~ruled[:-1]) + ruled[0]) if ruled.size else 0
 
-        final_layout = []
-        for block in publaynet_layout:
-            if block.type != "Table":
-                final_layout.append(block)
+#cheap table check on the page pixels: three horizontal rules spanning 30% of the width, or two of
+#them crossed by two vertical rules of 5% of the height; runs on a 4x pooled dark-pixel mask of
+#the green channel so one pixel thin rules survive
+def looks_like_table(image, pool=4):
+    gray = image[..., 1] if image.ndim == 3 else image
+    height, width = (gray.shape[0] // pool) * pool, (gray.shape[1] // pool) * pool
+    dark = gray[:height, :width] < 128
+    rows = np.logical_or.reduce([dark[offset::pool, ::2] for offset in range(pool)])
+    horizontal = count_rule_lines(rows, 0.3 * width / 2)
+    if horizontal >= 3:
+        return True
+    columns = np.logical_or.reduce([dark[::2, offset::pool] for offset in range(pool)])
+    vertical = count_rule_lines(columns.T, 0.05 * height / 2)
+    return horizontal >= 2 and vertical >= 2
 
-        # Add "Table" blocks from layout2 to the new list
-        for block in tablebank_layout:
-            if block.type == "Table":
-                final_layout.append(block)
+# pages seen and TableBank runs of this process, plus those pool workers handed back; detection
+# threads of the stream pipeline update it at once
+_tablebank_stats = {"pages": 0, "runs": 0, "seconds": 0.0}
+_tablebank_lock = Lock()
 
+def add_tablebank(stats):
+    with _tablebank_lock:
+        for name, value in stats.items():
+            _tablebank_stats[name] += value
+
+def tablebank_snapshot():
+    with _tablebank_lock:
+        return dict(_tablebank_stats)
+
+#counts added since `before` (a snapshot), e.g. one book's or one batch's
+def tablebank_since(before):
+    now = tablebank_snapshot()
+    return {name: now[name] - before[name] for name in now}
+
+#count the pages TableBank ran on and skipped; the time saved is estimated from its mean time per page
+def record_tablebank(pages, runs, seconds):
+    add_tablebank({"pages": pages, "runs": runs, "seconds": seconds})
+    metrics.count("tablebank:pages", pages)
+    metrics.count("tablebank:runs", runs)
+    metrics.count("tablebank:seconds", seconds)
+
+def tablebank_summary(stats):
+    pages, runs, seconds = stats.get("pages", 0), stats.get("runs", 0), stats.get("seconds", 0.0)
+    skipped = pages - runs
+    return {"pages": pages, "runs": runs, "skipped": skipped,
+            "skip_rate": round(skipped / max(pages, 1), 4),
+            "seconds_saved": round(skipped * seconds / runs, 2) if runs else None}
+
+#extract the page data from its rendered image and layout (detected here when not given)
+@timeit
+def process_image(page, image, final_layout, latex_text, bookname, bookId, digest=None, page_report=None, pending_tables=None):
+    page_num = page.number
+    try:
+        # the rendered page is shared by every block handler, which crop views out of it
+        if final_layout is None:
+            detect_image = render_page(page, **detect_settings(page))
+            final_layout = scale_layout(detect_layouts([detect_image])[0], detect_scale(page))
 
         page_tables=[]
         page_figures=[]
@@ -186,42 +943,61 @@ def process_image(imagepath, page_num, bookname, bookId):
         if not final_layout or not any(block.type in ["Table", "Figure"] for block in final_layout):
             try:
                 print("extracting using naugat")
-                page_content=extract_text_equation_with_nougat(imagepath, page_equations, page_num,bookname, bookId)
+                page_content=extract_text_equation_with_nougat(latex_text, page_equations)
+                record_text_source(page_report, "nougat")
                 return page_content, page_tables, page_figures, page_equations
 
             except Exception as e:
                     print(f"An error occurred while processing {bookname}, page {page_num} with nougat: {str(e)}")
-                    error={"error":str(e),"page_number":page_num, "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
-                    document=error_collection.find_one({"bookId":bookId})
-                    if document:
-                        error_collection.update_one({"_id": existing_document["_id"]}, {"$push": {"pages": error}})
-                    else:
-                        new_error_doc = {"bookId": bookId, "book": bookname, "error_pages": [error]}
-                        error_collection.insert_one(new_error_doc)
+                    record_page_error(bookId, bookname, page_num, e)
                     return "",[],[],[]
 
         #extract page content based on their region
-        page_content = sort_text_blocks_and_extract_data(final_layout,imagepath,page_tables,page_figures)
+        page_content = sort_text_blocks_and_extract_data(final_layout,image,page_tables,page_figures,digest,page,page_report,pending_tables)
         #extract equations
-        nougat_extraction = extract_text_equation_with_nougat(imagepath, page_equations, page_num,bookname, bookId)
+        nougat_extraction = extract_text_equation_with_nougat(latex_text, page_equations)
         return page_content,page_tables,page_figures, page_equations,nougat_extraction
 
     except Exception as e:
         print(f"An error occurred while processing {bookname}, page {page_num}: {str(e)}")
-        error={"error":str(e),"page_number":page_num, "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
-        document=error_collection.find_one({"bookId":bookId})
-        if document:
-            error_collection.update_one({"_id": existing_document["_id"]}, {"$push": {"pages": error}})
-        else:
-            new_error_doc = {"bookId": bookId, "book": bookname, "error_pages": [error]}
-            error_collection.insert_one(new_error_doc)
+        record_page_error(bookId, bookname, page_num, e)
+        if pending_tables is not None:
+            # the page is stored empty, like its tables were never sent
+            pending_tables.clear()
         return "", [], [],[]
 
-#sort the layout blocks and return page data 
+#append a page error to the book's error document
+def record_page_error(bookId, bookname, page_num, e):
+    error={"error":str(e),"page_number":page_num, "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
+    error_collection = get_db().error_collection
+    document=error_collection.find_one({"bookId":bookId})
+    if document:
+        error_collection.update_one({"_id": document["_id"]}, {"$push": {"error_pages": error}})
+    else:
+        new_error_doc = {"bookId": bookId, "book": bookname, "error_pages": [error]}
+        error_collection.insert_one(new_error_doc)
+
+#count the page under the path its text came from, and note it in the page report
+def record_text_source(page_report, source, ocr_blocks=0):
+    metrics.count(f"text_source:{source}")
+    if page_report is not None:
+        page_report["text_source"] = source
+        page_report["ocr_blocks"] = ocr_blocks
+
+#sort the layout blocks and return page data; with the fitz page its text layer replaces OCR when usable
 @timeit
-def sort_text_blocks_and_extract_data(blocks, imagepath,page_tables, page_figures):
+def sort_text_blocks_and_extract_data(blocks, image,page_tables, page_figures, digest=None, page=None, page_report=None, pending_tables=None):
     sorted_blocks = sorted(blocks, key=lambda block: (block.block.y_1 + block.block.y_2) / 2)
     output = ""
+    # with a pending_tables list from the caller the table markers are left for it to resolve
+    deferred = pending_tables is not None
+    if not deferred:
+        pending_tables = []
+    ocr = page_ocr(image, OCR_MODE, page if TEXT_LAYER == "auto" else None, TEXT_LAYER_MIN_CHARS)
+    # only OCR results go through the result cache, the text layer is cheaper to read than a lookup
+    cached_texts = cache_get("ocr", digest) if ocr.source == "ocr" else None
+    if cached_texts is not None:
+        ocr.texts.update(cached_texts)
     
     # Initialize variables to keep track of the previous and next blocks
     prev_block = None
@@ -233,298 +1009,166 @@ def sort_text_blocks_and_extract_data(blocks, imagepath,page_tables, page_figure
         if i < len(sorted_blocks) - 1:
             next_block = sorted_blocks[i + 1]   
         if block.type == "Table":
-            output = process_table(block, imagepath, output, page_tables)
+            output = process_table(block, image, output, pending_tables)
         elif block.type == "Figure":
-            output = process_figure(block, imagepath, prev_block, next_block, output, page_figures)
+            output = process_figure(block, image, ocr, prev_block, next_block, output, page_figures)
         elif block.type == "Text":
-            output = process_text(block, imagepath, output)
+            output = process_text(block, ocr, output)
         elif block.type == "Title":
-            output = process_title(block, imagepath, output)
+            output = process_title(block, ocr, output)
         elif block.type == "List":
-            output = process_list(block, imagepath, output)
+            output = process_list(block, ocr, output)
 
+    if ocr.source == "ocr" and (cached_texts is None or len(ocr.texts) > len(cached_texts)):
+        cache_put("ocr", digest, ocr.texts)
+    record_text_source(page_report, ocr.source, getattr(ocr, "ocr_blocks", 0))
+    if not deferred:
+        output = resolve_pending_tables(output, pending_tables, page_tables)
     page_content = re.sub(r'\s+', ' ', output).strip()
     return page_content
 
-#extract table and table_caption and return table object {id, data, caption}
+#encode an in-memory crop as png bytes for the table OCR service and S3
+def encode_png(cropped_image):
+    buffer = io.BytesIO()
+    Image.fromarray(cropped_image).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+#send the table crop to bud-ocr without waiting and leave a marker where its tables go
 @timeit
-def process_table(table_block, imagepath, output, page_tables):
+def process_table(table_block, image, output, pending_tables):
     x1, y1, x2, y2 = table_block.block.x_1, table_block.block.y_1, table_block.block.x_2, table_block.block.y_2
-    # Load the image
-    img = cv2.imread(imagepath)
-    # Increase top boundary by 70 pixels
-    y1 -= 70
-    if y1 < 0:
-        y1 = 0
-    # Increase left boundary to the image's width
-    x1 = 0
-    # Increase right boundary by 20 pixels
-    x2 += 20
-    if x2 > img.shape[1]:
-        x2 = img.shape[1]
-    # Increase bottom boundary by 20 pixels
-    y2 += 20
-    if y2 > img.shape[0]:
-        y2 = img.shape[0]
-    # Crop the specified region
-    cropped_image = img[int(y1):int(y2), int(x1):int(x2)]
-    # Save the cropped image
-    table_image_path ="cropped_table.png"
-    cv2.imwrite(table_image_path, cropped_image)
+    # Increase top boundary by 70 pixels, left boundary to the image's edge,
+    # right and bottom boundaries by 20 pixels
+    cropped_image = crop_region(image, 0, y1 - 70, x2 + 20, y2 + 20)
     
-    #process table and caption with bud-ocr
-    output=process_book_page(table_image_path,page_tables, output)
+    #process table and caption with bud-ocr, identical crops reuse the cached response
+    table_image = encode_png(cropped_image)
+    table_digest = content_digest(table_image) if get_result_cache() is not None else None
+    data = cache_get("table", table_digest)
+    if data is not None:
+        future = Future()
+        future.set_result(data)
+    else:
+        future = get_table_ocr_client().submit(table_image)
+    output += f"{{{{pending_table:{len(pending_tables)}}}}}"
+    pending_tables.append((table_digest, future, data is not None))
+    return output
 
-    if os.path.exists(table_image_path):
-        os.remove(table_image_path)
+#extract table and table_caption and return table object {id, data, caption}, replacing the
+#markers left by process_table in page order once their responses are in
+@timeit
+def resolve_pending_tables(output, pending_tables, page_tables):
+    for index, (table_digest, future, cached) in enumerate(pending_tables):
+        data = future.result()
+        if data is not None and not cached:
+            cache_put("table", table_digest, data)
+        output = output.replace(f"{{{{pending_table:{index}}}}}", process_book_page(data, page_tables, ""), 1)
     return output
 
 #extract figure and figure_caption and return figure object {id, figureUrl, caption}
 @timeit
-def process_figure(figure_block, imagepath, prev_block, next_block, output, page_figures):
+def process_figure(figure_block, image, ocr, prev_block, next_block, output, page_figures):
     caption=""
-    # Process the "Figure" block
-    x1, y1, x2, y2 = figure_block.block.x_1, figure_block.block.y_1, figure_block.block.x_2, figure_block.block.y_2
-    # Load the image
-    img = cv2.imread(imagepath)
-    # Expand the bounding box by 5 pixels on every side
-    x1-=5
-    y1-=5
-    x2+=5
-    y2+=5
-
-    # Ensure the coordinates are within the image boundaries
-    x1=max(0,x1)
-    y1=max(0,y1)
-    x2=min(img.shape[1],x2)
-    y2=min(img.shape[0],y2)
-
-    #crop the expanded bounding box
-    figure_bbox = img[int(y1):int(y2), int(x1):int(x2)]
-    figure_image_path = f"figure_6.png"
-    cv2.imwrite(figure_image_path,figure_bbox)
+    # Expand the bounding box by 5 pixels on every side and crop it
+    figure_bbox = crop_block(image, figure_block)
     figureId=uuid.uuid4().hex
     output += f"{{{{figure:{figureId}}}}}"
 
-    if prev_block:
-        prev_x1, prev_y1, prev_x2, prev_y2 = prev_block.block.x_1, prev_block.block.y_1, prev_block.block.x_2, prev_block.block.y_2
-        prev_x1 -= 5
-        prev_y1 -= 5
-        prev_x2 += 5
-        prev_y2 += 5
-        # Ensure the coordinates are within the image boundaries
-        prev_x1 = max(0, prev_x1)
-        prev_y1 = max(0, prev_y1)
-        prev_x2 = min(img.shape[1], prev_x2)
-        prev_y2 = min(img.shape[0], prev_y2)
-        # Crop the bounding box for the block before the "Figure" block
-        prev_bbox = img[int(prev_y1):int(prev_y2), int(prev_x1):int(prev_x2)]
-        # Save the cropped bounding box as an image
-        prev_image_path = f"prev_block{figureId}.png"
-        cv2.imwrite(prev_image_path, prev_bbox)
-        #extraction of text from cropped image using pytesseract
-        image =Image.open(prev_image_path)
-        text = pytesseract.image_to_string(image)
+    # Look for a "Fig. N"/"Figure N" caption in the blocks right before and after the figure
+    pattern = r"(Fig\.|Figure)\s+\d+"
+    for neighbour_block in (prev_block, next_block):
+        if not neighbour_block:
+            continue
+        text = ocr.text(neighbour_block)
         text = re.sub(r'\s+', ' ', text).strip()
-        pattern = r"(Fig\.|Figure)\s+\d+"
-        match = re.search(pattern, text)
-        if match:
-            caption = text
-        if os.path.exists(prev_image_path):
-            os.remove(prev_image_path)
-
-    if next_block:
-        next_x1, next_y1, next_x2, next_y2 = next_block.block.x_1, next_block.block.y_1, next_block.block.x_2, next_block.block.y_2
-         # Expand the bounding box by 5 pixels on every side
-        next_x1 -= 5
-        next_y1 -= 5
-        next_x2 += 5
-        next_y2 += 5
-        
-        # Ensure the coordinates are within the image boundaries
-        next_x1 = max(0, next_x1)
-        next_y1 = max(0, next_y1)
-        next_x2 = min(img.shape[1], next_x2)
-        next_y2 = min(img.shape[0], next_y2)
-        # Crop the bounding box for the block after the "Figure" block
-        next_bbox = img[int(next_y1):int(next_y2), int(next_x1):int(next_x2)]
-        # Save the cropped bounding box as an image
-        next_image_path = f"next_block_{figureId}.png"
-        cv2.imwrite(next_image_path, next_bbox)
-        #extraction of text from cropped image using pytesseract
-        image =Image.open(next_image_path)
-        text = pytesseract.image_to_string(image)
-        text = re.sub(r'\s+', ' ',text).strip()
-        pattern = r"(Fig\.|Figure)\s+\d+"
         match = re.search(pattern, text)
         if match:
             caption = text
-        if os.path.exists(next_image_path):
-            os.remove(next_image_path)
 
-    figure_url=upload_to_aws_s3(figure_image_path, figureId)
+    figure_url=upload_to_aws_s3(encode_png(figure_bbox))
     page_figures.append({
         "id":figureId,
         "url":figure_url,
         "caption":caption
     })
-    if os.path.exists(figure_image_path):
-        os.remove(figure_image_path)
     return output    
 
 #extract and return text from text block
 @timeit
-def process_text(text_block,imagepath, output):
-    x1, y1, x2, y2 = text_block.block.x_1, text_block.block.y_1, text_block.block.x_2, text_block.block.y_2
-    # Load the image
-    img = cv2.imread(imagepath)
-    # Add 10 pixels to each side of the rectangle
-    x1 -= 5
-    y1 -= 5
-    x2 += 5
-    y2 += 5
-    
-    # Ensure the coordinates are within the image boundaries
-    x1 = max(0, x1)
-    y1 = max(0, y1)
-    x2 = min(img.shape[1], x2)
-    y2 = min(img.shape[0], y2)
-    
-    # Crop the specified region
-    cropped_image = img[int(y1):int(y2), int(x1):int(x2)]
-    
-    # Save the cropped image
-    cropped_image_path = "text_block.png"
-    cv2.imwrite(cropped_image_path, cropped_image)
-    #extraction of text from cropped image using pytesseract
-    image =Image.open(cropped_image_path)
-    text = pytesseract.image_to_string(image)
-    output+=text
-    #delete cropped image
-    if os.path.exists(cropped_image_path):
-        os.remove(cropped_image_path)
+def process_text(text_block,ocr, output):
+    output+=ocr.text(text_block)
     return output
 
 #extract and return text from title block
 @timeit
-def process_title(title_block,imagepath, output):
-    x1, y1, x2, y2 = title_block.block.x_1, title_block.block.y_1, title_block.block.x_2, title_block.block.y_2
-    # Load the image
-    img = cv2.imread(imagepath)
-    # Add 10 pixels to each side of the rectangle
-    x1 -= 5
-    y1 -= 5
-    x2 += 5
-    y2 += 5
-    
-    # Ensure the coordinates are within the image boundaries
-    x1 = max(0, x1)
-    y1 = max(0, y1)
-    x2 = min(img.shape[1], x2)
-    y2 = min(img.shape[0], y2)
-    
-    # Crop the specified region
-    cropped_image = img[int(y1):int(y2), int(x1):int(x2)]
-    
-    # Save the cropped image
-    cropped_image_path = "title_block.png"
-    cv2.imwrite(cropped_image_path, cropped_image)
-    #extraction of text from cropped image using pytesseract
-    image =Image.open(cropped_image_path)
-    text = pytesseract.image_to_string(image)
-    output+=text
-    #delete cropped image
-    if os.path.exists(cropped_image_path):
-        os.remove(cropped_image_path)
+def process_title(title_block,ocr, output):
+    output+=ocr.text(title_block)
     return output
 
 #extract and return text from list block
 @timeit
-def process_list(list_block,imagepath, output):
-    x1, y1, x2, y2 = list_block.block.x_1, list_block.block.y_1, list_block.block.x_2, list_block.block.y_2
-    # Load the image
-    img = cv2.imread(imagepath)
-    # Add 10 pixels to each side of the rectangle
-    x1 -= 5
-    y1 -= 5
-    x2 += 5
-    y2 += 5
-    
-    # Ensure the coordinates are within the image boundaries
-    x1 = max(0, x1)
-    y1 = max(0, y1)
-    x2 = min(img.shape[1], x2)
-    y2 = min(img.shape[0], y2)
-    
-    # Crop the specified region
-    cropped_image = img[int(y1):int(y2), int(x1):int(x2)]
-    
-    # Save the cropped image
-    cropped_image_path = "list_block.png"
-    cv2.imwrite(cropped_image_path, cropped_image)
-    #extraction of text from cropped image using pytesseract
-    image =Image.open(cropped_image_path)
-    text = pytesseract.image_to_string(image)
-    output+=text
-    #delete cropped image
-    if os.path.exists(cropped_image_path):
-        os.remove(cropped_image_path)
+def process_list(list_block,ocr, output):
+    output+=ocr.text(list_block)
     return output
 
-#upload figure to aws and return aws url
-@timeit
-def upload_to_aws_s3(figure_image_path, figureId): 
-    folderName="book-set-2-Images"
-    s3_key = f"{folderName}/{figureId}.png"
-    # Upload the image to the specified S3 bucket
-    s3.upload_file(figure_image_path, bucket_name, s3_key)
-    # Get the URL of the uploaded image
-    figure_url = f"https://{bucket_name}.s3.amazonaws.com/{s3_key}"
+#background uploader of this process; thread pools do not survive a fork, so each worker builds its own
+def get_figure_uploader():
+    global _figure_uploader
+    with _singletons_lock:
+        if _figure_uploader is None or _figure_uploader[0] != os.getpid():
+            uploader = FigureUploader(get_s3(), os.environ['AWS_BUCKET_NAME'], max_workers=FIGURE_UPLOAD_WORKERS, max_pending=FIGURE_UPLOAD_QUEUE,
+                                      max_digests=FIGURE_UPLOAD_DIGESTS)
+            _figure_uploader = (os.getpid(), uploader)
+        return _figure_uploader[1]
+
+_figure_uploader = None
 
-    return figure_url 
+#queue the figure for upload to aws and return its aws url
+@timeit
+def upload_to_aws_s3(figure_bytes): 
+    return get_figure_uploader().upload(figure_bytes)
 
+#replace the equations in nougat's markdown with placeholders and return the page content
 @timeit
-def extract_text_equation_with_nougat(image_path, page_equations, page_num, bookname, bookId):
-    pdf_path="page.pdf"
-    with open(pdf_path, "wb") as pdf_file, open(image_path, "rb") as image_file:
-        pdf_file.write(img2pdf.convert(image_path))
-    latex_text=get_latext_text(pdf_path,page_num, bookname, bookId)
+def extract_text_equation_with_nougat(latex_text, page_equations):
     pattern = r'(\\\(.*?\\\)|\\\[.*?\\\])'
+    # the page's equations are converted together, each distinct one only once
+    speech = get_speech_cache().convert_many([match.group() for match in re.finditer(pattern, latex_text)])
     
     def replace_with_uuid(match):
         equationId = uuid.uuid4().hex
         match_text = match.group()
-        text_to_speech=latext_to_text_to_speech(match_text)
+        text_to_speech=speech[match_text]
         page_equations.append({'id': equationId, 'text': match_text, 'text_to_speech':text_to_speech})
         return f'{{{{equation:{equationId}}}}}'
     
     page_content = re.sub(pattern, replace_with_uuid, latex_text)
     page_content = re.sub(r'\s+', ' ', page_content).strip()
-    if os.path.exists(pdf_path):
-        os.remove(pdf_path)
     return page_content
-   
-@timeit
-def get_latext_text(pdf_path, page_num, bookname, bookId):
+
+#run the in-process nougat engine over a batch of page images and return the markdown of each page, None when it failed
+@timeit("nougat")
+def get_latext_text(images, page_numbers, bookname, bookId):
     try:
-        command=[
-            "nougat",
-            pdf_path,
-            "--no-skipping"
-        ]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return result.stdout
+        from nougat_engine import NougatEngine
+        return NougatEngine(NOUGAT_MODEL, NOUGAT_BATCH_SIZE).predict(images, page_numbers)
 
     except Exception as e:
-        print(f"An error occurred while processing {bookname}, page {page_num} with nougat: {str(e)}")
-        error={"error":str(e),"page_number":page_num, "line_number":traceback.extract_tb(e.__traceback__)[-1].lineno}
-        document=error_collection.find_one({"bookId":bookId})
-        if document:
-            error_collection.update_one({"_id": existing_document["_id"]}, {"$push": {"pages": error}})
-        else:
-            new_error_doc = {"bookId": bookId, "book": bookname, "error_pages": [error]}
-            error_collection.insert_one(new_error_doc)
-        return ""
+        print(f"An error occurred while processing {bookname}, pages {page_numbers[0]}-{page_numbers[-1]} with nougat: {str(e)}")
+        for page_num in page_numbers:
+            record_page_error(bookId, bookname, page_num, e)
+        return [None] * len(images)
+
+#run nougat once over the whole book and return the markdown of every page, None when it fails
+@timeit("nougat")
+def get_book_latext_text(pdf, num_pages, bookname, bookId):
+    try:
+        from nougat_engine import NougatEngine
+        return NougatEngine(NOUGAT_MODEL, NOUGAT_BATCH_SIZE).predict_pdf(pdf, num_pages)
+
+    except Exception as e:
+        print(f"An error occurred while processing {bookname} with nougat, falling back to page batches: {str(e)}")
+        return None
 
 @timeit
 def latext_to_text_to_speech(text):
@@ -536,17 +1180,32 @@ def latext_to_text_to_speech(text):
 
 
 if __name__=="__main__":
-    # process all books
-    # books = get_all_books_names('bud-datalake', 'book-set-2/')
-    # print(len(books))
-    # for book in books:
-    #     if book.endswith('.pdf'):
-    #         process_book(book)
-    #     else:
-    #         print(f"skipping this {book} as it it is not pdf")
-    #         error_collection.update_one({"book": book}, {"$set": {"error": f"{book} is not a pdf"}}, upsert=True)
-    #         continue
-    
-    # process single book
-    # process_book("A Beginner's Guide to R - Alain Zuur- Elena N Ieno- Erik Meesters.pdf")
-      process_book("https://s3.console.aws.amazon.com/s3/object/bud-datalake?region=ap-southeast-1&prefix=book-set-2/page_28+%285%29.pdf")
\ No newline at end of file
+    # distributed corpus processing:
+    #   python process_pdf.py enqueue bud-datalake book-set-2/   fill the book queue once
+    #   python process_pdf.py worker                             on every node/core, until the queue is empty
+    #   python process_pdf.py stats                              queue depth and per-worker rates
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description="Extract books from S3 into MongoDB")
+    commands = parser.add_subparsers(dest="command")
+    enqueue = commands.add_parser("enqueue")
+    enqueue.add_argument("bucket")
+    enqueue.add_argument("prefix")
+    worker = commands.add_parser("worker")
+    worker.add_argument("--poll", type=int, default=0, help="seconds to wait for new jobs instead of exiting on an empty queue")
+    commands.add_parser("stats")
+    args = parser.parse_args()
+
+    if metrics.METRICS_ENABLED and metrics.METRICS_PORT:
+        metrics.serve_prometheus()
+    if args.command == "enqueue":
+        enqueue_corpus(args.bucket, args.prefix)
+    elif args.command == "worker":
+        run_queue_worker(poll_seconds=args.poll)
+    elif args.command == "stats":
+        book_queue = get_book_queue()
+        book_queue.requeue_expired()
+        print(json.dumps(book_queue.stats(), indent=2))
+    else:
+        # process single book
+        process_books(["https://s3.console.aws.amazon.com/s3/object/bud-datalake?region=ap-southeast-1&prefix=book-set-2/page_28+%285%29.pdf"])
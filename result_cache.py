@@ -0,0 +1,117 @@
+import argparse
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+#content hash of page pixels / encoded crops, the array shape is part of the key
+def content_digest(content):
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(content, np.ndarray):
+        digest.update(str(content.shape).encode())
+        content = np.ascontiguousarray(content)
+    digest.update(memoryview(content))
+    return digest.hexdigest()
+
+# Content-addressed on-disk cache of per-stage results (layout blocks, OCR text, table OCR, nougat).
+# Entries are keyed by stage, the stage's model/config version and a content digest, live in one
+# sqlite file shared by every process, and are evicted least recently used once max_bytes is exceeded.
+class ResultCache:
+    def __init__(self, folder, max_bytes, versions):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, "results.sqlite")
+        self.max_bytes = max_bytes
+        self.versions = versions
+        self._local = threading.local()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (stage TEXT, version TEXT, digest TEXT, size INTEGER, "
+                "last_used REAL, value BLOB, PRIMARY KEY (stage, version, digest))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS counters (stage TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)")
+
+    # sqlite connections must not cross a fork or a thread, every process and thread opens its own
+    @property
+    def connection(self):
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=60)
+            self._local.connection.execute("PRAGMA journal_mode=WAL")
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, stage, digest):
+        version = self.versions.get(stage, "")
+        with self.connection:
+            row = self.connection.execute(
+                "SELECT value FROM entries WHERE stage = ? AND version = ? AND digest = ?", (stage, version, digest)).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE entries SET last_used = ? WHERE stage = ? AND version = ? AND digest = ?",
+                    (time.time(), stage, version, digest))
+            self._count(stage, hit=row is not None)
+        return pickle.loads(row[0]) if row is not None else None
+
+    def put(self, stage, digest, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (stage, self.versions.get(stage, ""), digest, len(blob), time.time(), blob))
+        self.evict()
+
+    # drop least recently used entries until the cache fits in max_bytes again
+    def evict(self):
+        with self.connection:
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            while total > self.max_bytes:
+                rows = self.connection.execute(
+                    "SELECT rowid, size FROM entries ORDER BY last_used LIMIT 64").fetchall()
+                if not rows:
+                    break
+                self.connection.executemany("DELETE FROM entries WHERE rowid = ?", [(rowid,) for rowid, size in rows])
+                total -= sum(size for rowid, size in rows)
+
+    # forget a stage after its model or config changed; only entries of other versions are dropped
+    # unless all_versions is set
+    def invalidate(self, stage, all_versions=False):
+        with self.connection:
+            if all_versions:
+                cursor = self.connection.execute("DELETE FROM entries WHERE stage = ?", (stage,))
+            else:
+                cursor = self.connection.execute(
+                    "DELETE FROM entries WHERE stage = ? AND version != ?", (stage, self.versions.get(stage, "")))
+        return cursor.rowcount
+
+    def _count(self, stage, hit):
+        self.connection.execute("INSERT OR IGNORE INTO counters VALUES (?, 0, 0)", (stage,))
+        column = "hits" if hit else "misses"
+        self.connection.execute(f"UPDATE counters SET {column} = {column} + 1 WHERE stage = ?", (stage,))
+
+    # hit/miss counters and size per stage, accumulated over every process using the cache
+    def stats(self):
+        stats = {}
+        for stage, hits, misses in self.connection.execute("SELECT stage, hits, misses FROM counters"):
+            stats[stage] = {"hits": hits, "misses": misses, "hit_rate": round(hits / max(hits + misses, 1), 4)}
+        for stage, entries, size in self.connection.execute("SELECT stage, COUNT(*), SUM(size) FROM entries GROUP BY stage"):
+            stats.setdefault(stage, {"hits": 0, "misses": 0, "hit_rate": 0.0}).update(entries=entries, bytes=size)
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the on-disk result cache")
+    parser.add_argument("--folder", default=os.environ.get("RESULT_CACHE_DIR", ".result_cache"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats")
+    invalidate = commands.add_parser("invalidate")
+    invalidate.add_argument("stage")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.folder, float("inf"), {})
+    if args.command == "stats":
+        print(cache.stats())
+    else:
+        print(f"removed {cache.invalidate(args.stage, all_versions=True)} {args.stage} entries")
@@ -0,0 +1,114 @@
+import contextvars
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import measure
+
+# Uploads figure images to S3 from memory on a small thread pool so the page loop never waits on
+# the network. Figures are stored under the hash of their bytes: an identical crop (a repeated
+# logo or icon) is uploaded once and every copy shares its URL. At most max_pending uploads are
+# queued; upload() blocks beyond that so memory stays bounded. The max_digests most recently used
+# figures are remembered for dedupe, a figure seen longer ago is uploaded again (to the same key).
+class FigureUploader:
+    def __init__(self, s3_client, bucket_name, folder_name="book-set-2-Images", max_workers=4, max_pending=32, max_digests=10000):
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.folder_name = folder_name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="figure-upload")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.uploads = OrderedDict()
+        self.max_digests = max_digests
+        # failed uploads whose error flush() already raised
+        self.reported = set()
+        self.uploaded = 0
+        self.deduplicated = 0
+
+    def url(self, s3_key):
+        return f"https://{self.bucket_name}.s3.amazonaws.com/{s3_key}"
+
+    # queue the png bytes for upload and return the figure url right away
+    def upload(self, figure_bytes):
+        digest = hashlib.sha256(figure_bytes).hexdigest()
+        s3_key = f"{self.folder_name}/{digest}.png"
+        with self.lock:
+            known = self.uploads.get(digest)
+            if known is not None and not self._failed(known):
+                self.uploads.move_to_end(digest)
+                self.deduplicated += 1
+                return self.url(s3_key)
+            # registered before the upload is queued, so a copy on another thread can wait for it
+            self.reported.discard(known)
+            future = self.uploads[digest] = Future()
+            self.uploads.move_to_end(digest)
+            self._trim()
+        self.slots.acquire()
+        self.executor.submit(contextvars.copy_context().run, self._upload, figure_bytes, s3_key, future)
+        return self.url(s3_key)
+
+    def _upload(self, figure_bytes, s3_key, future):
+        try:
+            with measure("upload"):
+                self.s3.upload_fileobj(io.BytesIO(figure_bytes), self.bucket_name, s3_key, ExtraArgs={"ContentType": "image/png"})
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self.slots.release()
+
+    #forget the least recently used finished uploads beyond max_digests, the ones in flight stay
+    def _trim(self):
+        excess = len(self.uploads) - self.max_digests
+        if excess <= 0:
+            return
+        finished = []
+        for digest, upload in self.uploads.items():
+            if len(finished) == excess:
+                break
+            if not isinstance(upload, Future) or upload.done():
+                finished.append(digest)
+        for digest in finished:
+            self.reported.discard(self.uploads.pop(digest))
+
+    @staticmethod
+    def _failed(upload):
+        return isinstance(upload, Future) and upload.done() and upload.exception() is not None
+
+    # wait for every queued upload and raise the error of one that failed since the last flush. A
+    # failed upload stays known, so every page holding its url sees the failure in wait(), until
+    # the next copy of the figure retries it
+    def flush(self):
+        with self.lock:
+            pending = [(digest, future) for digest, future in self.uploads.items()
+                       if isinstance(future, Future) and future not in self.reported]
+        try:
+            self._settle(pending)
+        finally:
+            with self.lock:
+                self.reported.update(future for digest, future in pending if self._failed(future))
+
+    # wait for the uploads behind these figure urls only, failures are handled like flush()
+    def wait(self, urls):
+        digests = {url.rsplit("/", 1)[-1][:-len(".png")] for url in urls}
+        with self.lock:
+            pending = [(digest, self.uploads[digest]) for digest in digests if isinstance(self.uploads.get(digest), Future)]
+        self._settle(pending)
+
+    def _settle(self, pending):
+        failure = None
+        for digest, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                failure = failure or e
+                continue
+            with self.lock:
+                if self.uploads.get(digest) is future:
+                    # keep only the digest for dedupe
+                    self.uploads[digest] = True
+                    self.uploaded += 1
+        if failure is not None:
+            raise failure
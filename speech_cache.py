@@ -0,0 +1,107 @@
+import re
+import threading
+from collections import OrderedDict
+
+import metrics
+from result_cache import content_digest
+
+# commands whose argument is typeset as text, where spaces are part of the content
+TEXT_GROUP = re.compile(r'\\(?:text(?:rm|it|bf|sf|tt|normal)?|mathrm|mbox)\s*\{')
+
+#math mode whitespace of a piece of an equation dropped
+def fold_math_spaces(text):
+    return re.sub(r'(?<![a-zA-Z\\]) |(?<!\\) (?![a-zA-Z])', '', text)
+
+#index just past the brace closing the group that starts after `start`, the end of the text when unbalanced
+def group_end(text, start):
+    depth = 1
+    index = start
+    while index < len(text) and depth:
+        char = text[index]
+        if char == '\\':
+            index += 1
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        index += 1
+    return index
+
+#canonical form of an equation used as its cache key: math mode ignores whitespace, except the
+#single space that ends a control word before a letter (`\alpha x`) and an escaped space (`\ `);
+#text-mode groups (`\text{cost = 5}`) keep their spaces
+def normalize_latex(text):
+    text = re.sub(r'\s+', ' ', text.strip())
+    parts = []
+    position = 0
+    for match in TEXT_GROUP.finditer(text):
+        if match.start() < position:
+            # nested in a text group already kept whole
+            continue
+        end = group_end(text, match.end())
+        parts.append(fold_math_spaces(text[position:match.start()]))
+        parts.append(text[match.start():end])
+        position = end
+    parts.append(fold_math_spaces(text[position:]))
+    return "".join(parts)
+
+# Memo of the spoken text of equations: an in-process LRU of max_entries in front of an optional
+# persistent store (a ResultCache, shared by every worker and kept across runs). Keys are the
+# normalized LaTeX, so `\( x^2 \)` and `\(x^2\)` are converted once. Safe to share between threads.
+class EquationSpeechCache:
+    def __init__(self, converter, store=None, max_entries=10000):
+        self.converter = converter
+        self.store = store
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    # spoken text of every equation, each distinct one looked up (or converted) once
+    def convert_many(self, equations):
+        with self.lock:
+            return self._convert_many(equations)
+
+    def _convert_many(self, equations):
+        results = {}
+        for equation in equations:
+            key = normalize_latex(equation)
+            if key in results:
+                # repeated on the page, converted or looked up only once
+                self.memory_hits += 1
+                metrics.count("speech:memory_hit")
+            else:
+                results[key] = self._convert(key, equation)
+        return {equation: results[normalize_latex(equation)] for equation in equations}
+
+    def convert(self, equation):
+        return self.convert_many([equation])[equation]
+
+    def _convert(self, key, equation):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+            metrics.count("speech:memory_hit")
+            return self.entries[key]
+        digest = content_digest(key.encode())
+        speech = self.store.get("speech", digest) if self.store is not None else None
+        if speech is not None:
+            self.store_hits += 1
+            metrics.count("speech:store_hit")
+        else:
+            self.misses += 1
+            metrics.count("speech:miss")
+            speech = self.converter(equation)
+            if self.store is not None:
+                self.store.put("speech", digest, speech)
+        self.entries[key] = speech
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return speech
+
+    def stats(self):
+        lookups = self.memory_hits + self.store_hits + self.misses
+        return {"memory_hits": self.memory_hits, "store_hits": self.store_hits, "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.store_hits) / max(lookups, 1), 4), "entries": len(self.entries)}
@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+
+import metrics
+
+_DONE = object()
+
+# One step of a StagePipeline: `func` takes an item and returns the item handed to the next stage,
+# with a batch_size it takes and returns lists of up to batch_size items (as many as are waiting).
+# `workers` threads run it; an ordered stage has a single worker that sees the items in input order.
+class Stage:
+    def __init__(self, name, func, workers=1, batch_size=None, ordered=False):
+        self.name = name
+        self.func = func
+        self.ordered = ordered
+        self.workers = 1 if ordered else max(1, workers)
+        self.batch_size = None if ordered or batch_size is None else max(1, batch_size)
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.max_depth = 0
+
+    def record(self, items, busy_seconds, blocked_seconds, depth):
+        with self.lock:
+            self.items += items
+            self.busy_seconds += busy_seconds
+            self.blocked_seconds += blocked_seconds
+            self.depth_samples += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+        metrics.count(f"pipeline:{self.name}:items", items)
+        metrics.count(f"pipeline:{self.name}:busy_seconds", busy_seconds)
+        metrics.count(f"pipeline:{self.name}:blocked_seconds", blocked_seconds)
+
+# Streams items through stages that all run at once, each reading from a queue of at most
+# queue_size items filled by the stage before it: a slow stage makes the ones before it wait
+# (backpressure) instead of letting items pile up in memory. run() yields the results in input
+# order. An exception escaping a stage stops every stage and is raised again from run().
+class StagePipeline:
+    def __init__(self, stages, queue_size=4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.stopped = threading.Event()
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def run(self, items):
+        self.started = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, args=(items,), name="pipeline-feed", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            # workers of the stage still running, the last one to stop passes the end on
+            running = [stage.workers]
+            threads += [threading.Thread(target=self._work, args=(index, running), name=f"pipeline-{stage.name}-{number}", daemon=True)
+                        for number in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            waiting = {}
+            next_seq = 0
+            while True:
+                entry = self._get(self.queues[-1])
+                if entry is _DONE:
+                    break
+                waiting[entry[0]] = entry[1]
+                while next_seq in waiting:
+                    yield waiting.pop(next_seq)
+                    next_seq += 1
+        finally:
+            # a consumer that stops early (or an error) lets every thread go
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            self.finished = time.perf_counter()
+        if self.error is not None:
+            raise self.error
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stopped.set()
+
+    def _get(self, source):
+        while not self.stopped.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _put(self, target, entry):
+        while not self.stopped.is_set():
+            try:
+                target.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self, items):
+        try:
+            for seq, item in enumerate(items):
+                if not self._put(self.queues[0], (seq, item)):
+                    return
+        except Exception as e:
+            self._fail(e)
+            return
+        self._put(self.queues[0], _DONE)
+
+    def _work(self, index, running):
+        stage = self.stages[index]
+        source, target = self.queues[index], self.queues[index + 1]
+        waiting = {}
+        next_seq = 0
+        while not self.stopped.is_set():
+            entry = self._get(source)
+            if entry is _DONE:
+                break
+            depth = source.qsize()
+            entries = [entry]
+            while len(entries) < (stage.batch_size or 1):
+                try:
+                    entry = source.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is _DONE:
+                    # there is room for it, this worker just took an item out
+                    source.put_nowait(_DONE)
+                    break
+                entries.append(entry)
+            if stage.ordered:
+                waiting.update(entries)
+                while next_seq in waiting:
+                    if not self._process(stage, [(next_seq, waiting.pop(next_seq))], target, depth):
+                        return
+                    next_seq += 1
+            elif not self._process(stage, entries, target, depth):
+                return
+        if self.stopped.is_set():
+            return
+        # the end marker stays in the queue for the stage's other workers
+        source.put_nowait(_DONE)
+        with stage.lock:
+            running[0] -= 1
+            last = running[0] == 0
+        if last:
+            source.get_nowait()
+            self._put(target, _DONE)
+
+    def _process(self, stage, entries, target, depth):
+        start_time = time.perf_counter()
+        try:
+            if stage.batch_size is not None:
+                results = stage.func([item for seq, item in entries])
+            else:
+                results = [stage.func(entries[0][1])]
+        except Exception as e:
+            self._fail(e)
+            return False
+        busy_seconds = time.perf_counter() - start_time
+        for (seq, item), result in zip(entries, results):
+            if not self._put(target, (seq, result)):
+                return False
+        stage.record(len(entries), busy_seconds, time.perf_counter() - start_time - busy_seconds, depth)
+        return True
+
+    # per stage: items done, utilization (busy share of its workers' time), mean/max depth of its
+    # input queue and seconds spent waiting for room downstream; the busiest stage with the fullest
+    # queue in front of it is the bottleneck
+    def stats(self):
+        elapsed = max((self.finished or time.perf_counter()) - (self.started or time.perf_counter()), 1e-9)
+        return {stage.name: {
+            "workers": stage.workers,
+            "items": stage.items,
+            "utilization": round(stage.busy_seconds / (stage.workers * elapsed), 3),
+            "queue_depth": self.queues[index].qsize(),
+            "mean_queue_depth": round(stage.depth_total / max(stage.depth_samples, 1), 2),
+            "max_queue_depth": stage.max_depth,
+            "blocked_seconds": round(stage.blocked_seconds, 3),
+        } for index, stage in enumerate(self.stages)}
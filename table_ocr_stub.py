@@ -0,0 +1,102 @@
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+#read the uploaded file out of a multipart/form-data body
+def multipart_file(content_type, body):
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    for part in message.iter_parts():
+        if part.get_param("name", header="content-disposition") == "file":
+            return part.get_payload(decode=True)
+    return None
+
+# Local stand-in for the table OCR service used by tests and benchmarks. POST /ocr answers with
+# the response recorded for the sha256 of the uploaded file (<recordings>/<sha256>.json); unknown
+# files get the recordings round robin, or an empty layout when there are none. With record_url set,
+# every upload is forwarded to the real service and its response saved as a new recording.
+class TableOCRStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, recordings, latency=0.0, record_url=None):
+        super().__init__(address, TableOCRStubHandler)
+        self.recordings = recordings
+        self.latency = latency
+        self.record_url = record_url
+        self.lock = threading.Lock()
+        self.requests = 0
+        os.makedirs(recordings, exist_ok=True)
+        self.fallback = itertools.cycle(sorted(
+            os.path.join(recordings, name) for name in os.listdir(recordings) if name.endswith(".json")) or [None])
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/ocr"
+
+    def response_for(self, image_bytes):
+        path = os.path.join(self.recordings, hashlib.sha256(image_bytes).hexdigest() + ".json")
+        if self.record_url is not None:
+            response = requests.post(self.record_url, files={'file': ('cropped_table.png', image_bytes, 'image/png')})
+            response.raise_for_status()
+            with open(path, "w") as f:
+                json.dump(response.json(), f)
+        elif not os.path.exists(path):
+            with self.lock:
+                path = next(self.fallback)
+        if path is None:
+            return {"layout": [], "result": []}
+        with open(path) as f:
+            return json.load(f)
+
+class TableOCRStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/ocr":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        image_bytes = multipart_file(self.headers.get("Content-Type", ""), body)
+        if image_bytes is None:
+            self.send_error(400, "missing file")
+            return
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        payload = json.dumps(self.server.response_for(image_bytes)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+#start the stand-in on a background thread (port 0 picks a free port), stop it with shutdown()
+def serve(recordings, host="127.0.0.1", port=0, latency=0.0, record_url=None):
+    server = TableOCRStub((host, port), recordings, latency, record_url)
+    threading.Thread(target=server.serve_forever, name="table-ocr-stub", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded table OCR responses on a local port")
+    parser.add_argument("--recordings", default="table_ocr_recordings")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--record", metavar="URL", help="proxy to the real service and save its responses")
+    args = parser.parse_args()
+
+    server = TableOCRStub((args.host, args.port), args.recordings, args.latency, args.record)
+    print(f"table OCR stub listening on {server.url}")
+    server.serve_forever()
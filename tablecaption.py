@@ -1,31 +1,72 @@
 
 import os
 import json
+import contextvars
 import requests
-import math
 import uuid
 import re
-from bs4 import BeautifulSoup
+import threading
+import numpy as np
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import timed
+
+TABLE_OCR_URL = os.environ.get('TABLE_OCR_URL', 'http://91.203.132.119:8000/ocr')
+# tables in flight at once per process, connect/read timeouts in seconds, retries of failed calls
+TABLE_OCR_CONCURRENCY = int(os.environ.get('TABLE_OCR_CONCURRENCY', 4))
+TABLE_OCR_TIMEOUT = (float(os.environ.get('TABLE_OCR_CONNECT_TIMEOUT', 10)), float(os.environ.get('TABLE_OCR_READ_TIMEOUT', 180)))
+TABLE_OCR_RETRIES = int(os.environ.get('TABLE_OCR_RETRIES', 3))
+
+#text of a table cell exactly as BeautifulSoup's get_text(strip=True) gives it: every text node
+#stripped and joined without separator, comments left out
+def cell_text(cell):
+    parts = []
+    def collect(element):
+        if isinstance(element.tag, str) and element.text:
+            parts.append(element.text.strip())
+        for child in element:
+            collect(child)
+            if child.tail:
+                parts.append(child.tail.strip())
+    collect(cell)
+    return "".join(parts)
+
+def cell_span(cell, name):
+    try:
+        return max(int(cell.get(name, 1)), 1)
+    except ValueError:
+        return 1
+
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+#rows of cell texts of the first table in the html, and the rowspan/colspan of every cell spanning
+#more than one row or column as {"row", "col", "rowspan", "colspan"} (row/col index into the rows).
+#The rows are BeautifulSoup's (html.parser) for well-formed html. Where they differ: an unclosed
+#<td>/<tr> ends at the next cell or row as in a browser, where html.parser nested the rest of the
+#row inside it; an <?xml ...?> declaration is dropped (lxml refuses it on a str); html without a
+#table gives no rows instead of raising
+def parse_table(html):
+    rows = []
+    spans = []
+    html = XML_DECLARATION.sub('', html, count=1)
+    table = next(lxml_html.fromstring(html).iter('table'), None) if html.strip() else None
+    if table is None:
+        return rows, spans
+    for row in table.iter('tr'):
+        row_data = []
+        for cell in row.iter('td', 'th'):
+            rowspan, colspan = cell_span(cell, 'rowspan'), cell_span(cell, 'colspan')
+            if rowspan > 1 or colspan > 1:
+                spans.append({"row": len(rows), "col": len(row_data), "rowspan": rowspan, "colspan": colspan})
+            row_data.append(cell_text(cell))
+        rows.append(row_data)
+    return rows, spans
 
 def parse_html_table(html):
-    data = []
-    
-    # Create a BeautifulSoup object to parse the HTML content
-    soup = BeautifulSoup(html, 'html.parser')
-    
-    # Find the table within the HTML
-    table = soup.find('table')
-    
-    # Find all rows within the table
-    rows = table.find_all('tr')
-    
-    # Loop through rows and extract cell data
-    for row in rows:
-        cells = row.find_all(['td', 'th'])
-        row_data = [cell.get_text(strip=True) for cell in cells]
-        data.append(row_data)
-    
-    return data
+    return parse_table(html)[0]
 
 def extract_table_results(data):
     layout_objects = data["layout"]
@@ -34,59 +75,163 @@ def extract_table_results(data):
     for layout_obj in layout_objects:
         if layout_obj["type"] == "table":
             table_html = layout_obj["res"]["html"]  # Access the HTML content of the table
-            parsed_table = parse_html_table(table_html)
+            parsed_table = parse_table(table_html)
             table_results.append(parsed_table)
     
     return table_results
 
-def find_distance(point1, point2):
-    return math.sqrt((point1[0] - point2[0])**2 + (point1[1] - point2[1])**2)
+# below this many layout box x OCR line pairs the python loop beats building the arrays
+# (`python benchmarks.py captions`)
+VECTORIZED_MIN_PAIRS = 200
+
+#axis aligned (x1, y1, x2, y2) box of a 4 point OCR quad
+def quad_box(quad):
+    (x1, y1), (x2, y2), (x3, y3), (x4, y4) = quad
+    return min(x1, x2, x3, x4), min(y1, y2, y3, y4), max(x1, x2, x3, x4), max(y1, y2, y3, y4)
+
+#axis aligned (x1, y1, x2, y2) boxes of the OCR result lines ([polygon, (text, score)] entries), whose
+#boxes are 4 point quads; the points go into one flat array, no python object per line
+def result_boxes(entries):
+    if not entries:
+        return np.empty((0, 4))
+    points = chain.from_iterable(chain.from_iterable(bbox_and_value[0] for bbox_and_value in entries))
+    quads = np.fromiter(points, dtype=float, count=8 * len(entries)).reshape(len(entries), 8)
+    xs, ys = quads[:, 0::2], quads[:, 1::2]
+    return np.stack([np.minimum(np.minimum(xs[:, 0], xs[:, 1]), np.minimum(xs[:, 2], xs[:, 3])),
+                     np.minimum(np.minimum(ys[:, 0], ys[:, 1]), np.minimum(ys[:, 2], ys[:, 3])),
+                     np.maximum(np.maximum(xs[:, 0], xs[:, 1]), np.maximum(xs[:, 2], xs[:, 3])),
+                     np.maximum(np.maximum(ys[:, 0], ys[:, 1]), np.maximum(ys[:, 2], ys[:, 3]))], axis=1)
+
+#matrix of squared box-to-box distances between every box of `boxes1` and `boxes2`, 0 where they
+#overlap, and of squared distances between their top left corners, which break ties
+def box_distances(boxes1, boxes2):
+    boxes1 = np.asarray(boxes1, dtype=float).reshape(-1, 4)[:, None, :]
+    boxes2 = np.asarray(boxes2, dtype=float).reshape(-1, 4)[None, :, :]
+    gap_x = np.maximum(0, np.maximum(boxes1[..., 0] - boxes2[..., 2], boxes2[..., 0] - boxes1[..., 2]))
+    gap_y = np.maximum(0, np.maximum(boxes1[..., 1] - boxes2[..., 3], boxes2[..., 1] - boxes1[..., 3]))
+    corner_x, corner_y = boxes1[..., 0] - boxes2[..., 0], boxes1[..., 1] - boxes2[..., 1]
+    return gap_x * gap_x + gap_y * gap_y, corner_x * corner_x + corner_y * corner_y
+
+#index into boxes2 of the closest box for every box of boxes1; both paths give the same indexes
+#(`python benchmarks.py captions` checks them against each other)
+def closest_boxes(boxes1, boxes2):
+    if len(boxes1) * len(boxes2) < VECTORIZED_MIN_PAIRS:
+        return closest_boxes_loop(boxes1, boxes2)
+    return closest_boxes_arrays(boxes1, boxes2)
+
+#closest_boxes over the distance matrices: the smallest distance, ties to the smallest corner distance
+def closest_boxes_arrays(boxes1, boxes2):
+    distances, corners = box_distances(boxes1, boxes2)
+    ties = distances == distances.min(axis=1, keepdims=True)
+    return np.where(ties, corners, np.inf).argmin(axis=1)
+
+#closest_boxes in python: the first box with the smallest distance, then corner distance
+def closest_boxes_loop(boxes1, boxes2):
+    closest = []
+    for ax1, ay1, ax2, ay2 in boxes1:
+        best_index, best_distance, best_corner = None, None, None
+        for index, (bx1, by1, bx2, by2) in enumerate(boxes2):
+            gap_x = bx1 - ax2 if bx1 > ax2 else ax1 - bx2 if ax1 > bx2 else 0
+            gap_y = by1 - ay2 if by1 > ay2 else ay1 - by2 if ay1 > by2 else 0
+            distance = gap_x * gap_x + gap_y * gap_y
+            if best_distance is not None and distance > best_distance:
+                continue
+            corner = (ax1 - bx1) ** 2 + (ay1 - by1) ** 2
+            if best_distance is None or distance < best_distance or corner < best_corner:
+                best_index, best_distance, best_corner = index, distance, corner
+        closest.append(best_index)
+    return closest
+
+#closest OCR result line ([polygon, (text, score)]) for each layout box
+def find_closest_bboxes(layout_bboxes, result_array):
+    entries = [bbox_and_value for result_item in result_array for bbox_and_value in result_item]
+    if not entries:
+        return [None] * len(layout_bboxes)
+    if len(layout_bboxes) * len(entries) < VECTORIZED_MIN_PAIRS:
+        boxes = [quad_box(bbox_and_value[0]) for bbox_and_value in entries]
+    else:
+        boxes = result_boxes(entries)
+    return [entries[index] for index in closest_boxes(layout_bboxes, boxes)]
 
 def find_closest_bbox(layout_bbox, result_array):
-    min_distance = float('inf')
-    closest_result = None
-    
-    for result_item in result_array:
-        for bbox_and_value in result_item:
-            result_bbox = bbox_and_value[0][0]
-            distance = find_distance(layout_bbox, result_bbox)
-            if distance < min_distance:
-                min_distance = distance
-                closest_result = bbox_and_value
-                
-    return closest_result
+    return find_closest_bboxes([layout_bbox], result_array)[0]
 
+#caption text for every table of the response (in layout order): the OCR line closest to the
+#table_caption block closest to the table, "" when there is none
 def find_closest_results_for_table_caption(data):
     layout_objects = data["layout"]
-    result_array = data["result"]
-    closest_values = []
-    
-    for layout_obj in layout_objects:
-        if layout_obj["type"] == "table_caption" and "bbox" in layout_obj:
-            layout_bbox = layout_obj["bbox"]
-            closest_result = find_closest_bbox(layout_bbox, result_array)
-            if closest_result:
-                closest_value = closest_result[1][0]
-                closest_values.append(closest_value)
-    
+    tables = [layout_obj for layout_obj in layout_objects if layout_obj["type"] == "table"]
+    captions = [layout_obj["bbox"] for layout_obj in layout_objects
+                if layout_obj["type"] == "table_caption" and "bbox" in layout_obj]
+    closest_values = [""] * len(tables)
+    located = [idx for idx, table in enumerate(tables) if "bbox" in table]
+    if not captions or not located:
+        return closest_values
+    closest_lines = find_closest_bboxes(captions, data["result"])
+    nearest_captions = closest_boxes([tables[idx]["bbox"] for idx in located], captions)
+    for idx, caption_idx in zip(located, nearest_captions):
+        closest_result = closest_lines[caption_idx]
+        if closest_result:
+            closest_values[idx] = closest_result[1][0]
     return closest_values
 # Example data
 
-def process_book_page(image_path, page_tables, output):
-
-    files = {
-        'file': (image_path, open(image_path, 'rb'))
-    }
-    response = requests.post('http://91.203.132.119:8000/ocr', files=files)
+# Client for the table OCR service: one keep-alive connection pool, at most max_concurrency
+# requests in flight, timeouts on every call and retries with exponential backoff on connection
+# errors and 429/5xx responses. Table crops are sent as in-memory png bytes.
+class TableOCRClient:
+    def __init__(self, url=TABLE_OCR_URL, max_concurrency=TABLE_OCR_CONCURRENCY, timeout=TABLE_OCR_TIMEOUT,
+                 retries=TABLE_OCR_RETRIES, backoff_factor=0.5):
+        self.url = url
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["POST"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="table-ocr")
 
-    if response.status_code == 200:
-        data = response.json()
-    else:
+    #send a table crop to the OCR service and return its response, None when the request failed
+    @timed("table_ocr")
+    def request(self, image_bytes):
+        files = {
+            'file': ('cropped_table.png', image_bytes, 'image/png')
+        }
+        try:
+            response = self.session.post(self.url, files=files, timeout=self.timeout)
+        except requests.RequestException as e:
+            print('API request failed:', str(e))
+            return None
+        if response.status_code == 200:
+            return response.json()
         print('API request failed with status code:', response.status_code)
+        return None
+
+    #same as request, without waiting; returns a future of the response
+    def submit(self, image_bytes):
+        # the request is timed under the submitting page's book/page tags
+        return self.executor.submit(contextvars.copy_context().run, self.request, image_bytes)
+
+_table_ocr_client = None
+_table_ocr_client_lock = threading.Lock()
+
+#client of this process; its thread pool does not survive a fork, so each worker builds its own.
+#Pipeline threads reach it at the same time, only one of them builds it
+def get_table_ocr_client():
+    global _table_ocr_client
+    with _table_ocr_client_lock:
+        if _table_ocr_client is None or _table_ocr_client[0] != os.getpid():
+            _table_ocr_client = (os.getpid(), TableOCRClient())
+        return _table_ocr_client[1]
+
+#add the tables of an OCR service response to the page and their placeholders to the output
+def process_book_page(data, page_tables, output):
+    if data is None:
+        return output
     tables = extract_table_results(data)
-    caption = find_closest_results_for_table_caption(data)
-    for idx, table_data in enumerate(tables):
-        caption = caption[idx] if idx < len(caption) else ""
+    captions = find_closest_results_for_table_caption(data)
+    for (table_data, spans), caption in zip(tables, captions):
         if should_skip_table(table_data):
             continue
         table_id = uuid.uuid4().hex
@@ -97,7 +242,8 @@ def process_book_page(image_path, page_tables, output):
             "id": table_id,
             "caption": caption,
             "data": {
-                "rows": rows
+                "rows": rows,
+                "spans": spans
                 }
             })
         output+= f"{{{{table:{table_id}}}}}"
@@ -1,14 +1,8 @@
-import time
-from functools import wraps
+from metrics import timed
 
-def timeit(func):
-    @wraps(func)
-    def timeit_wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
-        result = func(*args, **kwargs)
-        end_time = time.perf_counter()
-        total_time = end_time - start_time
-        # first item in the args, ie `args[0]` is `self`
-        print(f'Function {func.__name__} Took {total_time:.4f} seconds')
-        return result
-    return timeit_wrapper
+#record the function's latency in the stage metrics, under its own name or a stage name:
+#@timeit or @timeit("render")
+def timeit(func_or_stage):
+    if callable(func_or_stage):
+        return timed()(func_or_stage)
+    return timed(func_or_stage)
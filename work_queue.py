@@ -0,0 +1,140 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Mongo-backed queue of book jobs shared by any number of worker processes or nodes.
+# A worker claims a job with an expiring lease and keeps it alive with heartbeats; a job whose
+# lease runs out (its worker died) is claimable again, up to max_attempts claims.
+class BookQueue:
+    def __init__(self, jobs, workers, lease_seconds=600, max_attempts=3):
+        self.jobs = jobs
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def ensure_indexes(self):
+        self.jobs.create_index([("url", ASCENDING)], unique=True)
+        self.jobs.create_index([("status", ASCENDING), ("lease_until", ASCENDING), ("enqueued_at", ASCENDING)])
+        self.workers.create_index([("worker_id", ASCENDING)], unique=True)
+
+    # add books to the queue, books already queued (in any state) are left alone
+    def enqueue(self, urls):
+        added = 0
+        for url in urls:
+            try:
+                result = self.jobs.update_one(
+                    {"url": url},
+                    {"$setOnInsert": {"url": url, "status": "queued", "attempts": 0, "enqueued_at": time.time()}},
+                    upsert=True)
+            except DuplicateKeyError:
+                continue
+            added += result.upserted_id is not None
+        return added
+
+    # atomically take the oldest queued job, or one whose lease expired
+    def claim(self, worker_id):
+        now = time.time()
+        return self.jobs.find_one_and_update(
+            {"attempts": {"$lt": self.max_attempts},
+             "$or": [{"status": "queued"}, {"status": "running", "lease_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "worker": worker_id, "claimed_at": now, "lease_until": now + self.lease_seconds},
+             "$inc": {"attempts": 1}},
+            sort=[("enqueued_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    # extend the lease, False when the job was meanwhile taken over by another worker
+    def heartbeat(self, job, worker_id):
+        result = self.jobs.update_one(
+            {"_id": job["_id"], "worker": worker_id, "status": "running"},
+            {"$set": {"lease_until": time.time() + self.lease_seconds}})
+        return result.matched_count == 1
+
+    def complete(self, job, worker_id, pages):
+        self.jobs.update_one(
+            {"_id": job["_id"], "worker": worker_id},
+            {"$set": {"status": "done", "pages": pages, "finished_at": time.time()}, "$unset": {"lease_until": ""}})
+
+    # give the job back to the queue, or park it as failed once it used up its attempts
+    def fail(self, job, worker_id, error):
+        status = "queued" if job["attempts"] < self.max_attempts else "failed"
+        self.jobs.update_one(
+            {"_id": job["_id"], "worker": worker_id},
+            {"$set": {"status": status, "error": str(error)}, "$unset": {"lease_until": ""}})
+
+    # put jobs of dead workers back to queued so the queue depth shows them
+    def requeue_expired(self):
+        now = time.time()
+        requeued = self.jobs.update_many(
+            {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$lt": self.max_attempts}},
+            {"$set": {"status": "queued"}, "$unset": {"lease_until": ""}})
+        failed = self.jobs.update_many(
+            {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$gte": self.max_attempts}},
+            {"$set": {"status": "failed", "error": "lease expired"}, "$unset": {"lease_until": ""}})
+        return requeued.modified_count, failed.modified_count
+
+    def register_worker(self, worker_id):
+        now = time.time()
+        self.workers.update_one(
+            {"worker_id": worker_id},
+            {"$set": {"host": socket.gethostname(), "pid": os.getpid(), "started_at": now, "last_seen": now,
+                      "books": 0, "pages": 0, "busy_seconds": 0.0}},
+            upsert=True)
+
+    def record_progress(self, worker_id, books, pages, busy_seconds):
+        self.workers.update_one(
+            {"worker_id": worker_id},
+            {"$set": {"last_seen": time.time()}, "$inc": {"books": books, "pages": pages, "busy_seconds": busy_seconds}})
+
+    # queue depth per status and throughput of every worker seen in the last `active_seconds`
+    def stats(self, active_seconds=3600):
+        depth = {doc["_id"]: doc["count"] for doc in self.jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])}
+        now = time.time()
+        workers = []
+        for doc in self.workers.find({"last_seen": {"$gte": now - active_seconds}}):
+            elapsed = max(doc["last_seen"] - doc["started_at"], 1e-9)
+            workers.append({
+                "worker_id": doc["worker_id"],
+                "host": doc.get("host"),
+                "books": doc["books"],
+                "pages": doc["pages"],
+                "pages_per_minute": round(60 * doc["pages"] / elapsed, 2),
+                "utilization": round(doc["busy_seconds"] / elapsed, 3),
+            })
+        return {"depth": depth, "workers": workers,
+                "pages_per_minute": round(sum(worker["pages_per_minute"] for worker in workers), 2)}
+
+def new_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+# Keeps a claimed job's lease alive from a background thread while the book is processed
+class LeaseHeartbeat:
+    def __init__(self, book_queue, job, worker_id, interval):
+        self.book_queue = book_queue
+        self.job = job
+        self.worker_id = worker_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self._beat, name="lease-heartbeat", daemon=True)
+
+    def _beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.book_queue.heartbeat(self.job, self.worker_id):
+                    self.lost = True
+                    return
+            except Exception as e:
+                print("Lease heartbeat failed:", str(e))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()